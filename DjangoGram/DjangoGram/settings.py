@@ -98,6 +98,12 @@ DATABASES = {
     }
 }
 
+# Every worker and host must share this cache, e.g. redis://redis:6379/0, so they see each other's locks
+# and invalidations. The default local memory cache is private to a process, it only suits development and tests
+CACHES = {
+    'default': env.cache_url('CACHE_URL', default='locmemcache://'),
+}
+
 CLOUDINARY = {
   'cloud_name': env('CLOUDINARY_CLOUD_NAME'),
   'api_key': env('CLOUDINARY_API_KEY'),
@@ -152,6 +158,34 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Backend which keeps post images and avatars, see dj_gram/image_storage.py.
+# LocalImageStorage keeps them under IMAGE_STORAGE_ROOT and needs no remote API
+IMAGE_STORAGE_BACKEND = env('IMAGE_STORAGE_BACKEND', default='dj_gram.image_storage.CloudinaryImageStorage')
+IMAGE_STORAGE_ROOT = os.path.join(MEDIA_ROOT, 'images')
+IMAGE_STORAGE_URL = '/images/'
+# internal nginx location of IMAGE_STORAGE_ROOT, files are sent by nginx when it's set
+IMAGE_STORAGE_ACCEL_REDIRECT_URL = env('IMAGE_STORAGE_ACCEL_REDIRECT_URL', default='')
+
+# Authors with more followers are not fanned out to follower timelines,
+# their recent posts are merged into timelines on read
+TIMELINE_FAN_OUT_THRESHOLD = env.int('TIMELINE_FAN_OUT_THRESHOLD', 10000)
+# Followers of those authors are counted in this many rows, so concurrent follows don't wait
+# for the lock of one counter. 0 keeps a single counter for every account
+FOLLOWER_COUNT_SHARDS = env.int('FOLLOWER_COUNT_SHARDS', 0)
+
+# Private files of the app, MEDIA_ROOT is served to anyone
+VAR_ROOT = os.path.join(BASE_DIR, 'var')
+
+# Snapshots of the follow graph built by the build_follow_graph command, see dj_gram/follow_graph.py.
+# Workers of a host map the same files, so it must be on a volume they share
+FOLLOW_GRAPH_ROOT = os.path.join(VAR_ROOT, 'follow_graph')
+
+# Original uploads waiting for the image worker, they keep their EXIF metadata.
+# The web and image workers must share it
+RAW_IMAGE_ROOT = os.path.join(VAR_ROOT, 'raw_images')
+
+TEST_RUNNER = 'dj_gram.tests.runner.LocalImageStorageTestRunner'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
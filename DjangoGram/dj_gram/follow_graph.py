@@ -0,0 +1,242 @@
+"""
+Read-only snapshot of the follow graph for lookups which never touch the database.
+
+The snapshot is a CSR adjacency of int64 arrays in one file, memory-mapped, so all workers
+of a host share its pages:
+
+    header | user_ids[n] | offsets[n + 1] | followed_ids[edges]
+
+user_ids are sorted ids of users who follow anyone, followed_ids[offsets[i]:offsets[i + 1]]
+are sorted ids of users followed by user_ids[i]. Both are looked up by binary search.
+
+Follows and unfollows committed after the snapshot are appended to a delta log of the same
+generation and applied on top of it, the build_follow_graph command starts a new generation.
+"""
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from mmap import ACCESS_READ, mmap
+
+from django.conf import settings
+
+HEADER = struct.Struct('<8sqq')  # magic, users, edges
+MAGIC = b'DJGRAPH1'
+DELTA = struct.Struct('<qq')  # follower id, followed id which is negative for an unfollow
+ITEM_SIZE = array('q').itemsize
+CURRENT_FILE = 'CURRENT'
+
+
+def get_snapshot_path(root, generation):
+    return os.path.join(root, f'{generation}.graph')
+
+
+def get_delta_log_path(root, generation):
+    return os.path.join(root, f'{generation}.log')
+
+
+def get_current_generation(root):
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as current:
+            return int(current.read())
+    except FileNotFoundError:
+        return None
+
+
+def log_delta(follower_id, followed_id, followed):
+    """
+    Appends a follow or an unfollow to the delta log of the current generation, must be called
+    after the follow is committed. Does nothing until the first snapshot is built.
+    """
+    root = settings.FOLLOW_GRAPH_ROOT
+    generation = get_current_generation(root)
+    if generation is None:
+        return
+
+    # appends of one record are atomic, so concurrent workers don't interleave records
+    fd = os.open(get_delta_log_path(root, generation), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, DELTA.pack(follower_id, followed_id if followed else -followed_id))
+    finally:
+        os.close(fd)
+
+
+def write_snapshot(root, edges, chunk_size=10000):
+    """
+    Writes a new generation from (follower_id, followed_id) pairs sorted by follower and followed,
+    then makes it current. The previous generation is kept for workers which still read it.
+    Returns (generation, users, edges).
+    """
+    os.makedirs(root, exist_ok=True)
+    generation = (get_current_generation(root) or 0) + 1
+    # follows committed from now on are logged to the new generation, the edges are read after the switch
+    open(get_delta_log_path(root, generation), 'ab').close()
+    _set_current_generation(root, generation)
+
+    path = get_snapshot_path(root, generation)
+    followed_path = path + '.followed.tmp'
+    user_ids, offsets, followed_ids = array('q'), array('q', [0]), array('q')
+    edge_count = 0
+    with open(followed_path, 'wb') as followed_file:
+        for follower_id, followed_id in edges:
+            if not user_ids or user_ids[-1] != follower_id:
+                if user_ids:
+                    offsets.append(edge_count)
+                user_ids.append(follower_id)
+            followed_ids.append(followed_id)
+            edge_count += 1
+            if len(followed_ids) >= chunk_size:
+                followed_ids.tofile(followed_file)
+                del followed_ids[:]
+        followed_ids.tofile(followed_file)
+    if user_ids:
+        offsets.append(edge_count)
+
+    with open(path + '.tmp', 'wb') as snapshot, open(followed_path, 'rb') as followed_file:
+        snapshot.write(HEADER.pack(MAGIC, len(user_ids), edge_count))
+        user_ids.tofile(snapshot)
+        offsets.tofile(snapshot)
+        while True:
+            chunk = followed_file.read(chunk_size * ITEM_SIZE)
+            if not chunk:
+                break
+            snapshot.write(chunk)
+    os.remove(followed_path)
+    os.replace(path + '.tmp', path)
+
+    _remove_generations(root, keep=(generation - 1, generation))
+    return generation, len(user_ids), edge_count
+
+
+def _set_current_generation(root, generation):
+    current_path = os.path.join(root, CURRENT_FILE)
+    with open(current_path + '.tmp', 'w') as current:
+        current.write(str(generation))
+    os.replace(current_path + '.tmp', current_path)
+
+
+def _remove_generations(root, keep):
+    for name in os.listdir(root):
+        generation, extension = os.path.splitext(name)
+        if extension in ('.graph', '.log') and generation.isdigit() and int(generation) not in keep:
+            os.remove(os.path.join(root, name))
+
+
+class FollowGraph:
+    """Snapshot of one generation with its delta log applied, see the module docstring"""
+
+    def __init__(self, root, generation):
+        self.root = root
+        self.generation = generation
+        with open(get_snapshot_path(root, generation), 'rb') as snapshot:
+            self._mmap = mmap(snapshot.fileno(), 0, access=ACCESS_READ)
+
+        magic, users, edges = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f'{get_snapshot_path(root, generation)} is not a follow graph snapshot')
+
+        view = memoryview(self._mmap)[HEADER.size:].cast('q')
+        self.user_ids = view[:users]
+        self.offsets = view[users:users + users + 1]
+        self.followed_ids = view[users + users + 1:users + users + 1 + edges]
+
+        self._delta_log_offset = 0
+        self._added = {}  # {follower_id: set of followed ids}
+        self._removed = {}
+        self.apply_delta_log()
+
+    def apply_delta_log(self):
+        """
+        Applies records appended since the last call, a delta always wins over the snapshot.
+        Returns ids of users whose follows have changed.
+        """
+        try:
+            with open(get_delta_log_path(self.root, self.generation), 'rb') as log:
+                log.seek(self._delta_log_offset)
+                data = log.read()
+        except FileNotFoundError:
+            return set()
+
+        data = data[:len(data) - len(data) % DELTA.size]  # a record may be half written
+        changed_user_ids = set()
+        for follower_id, followed_id in DELTA.iter_unpack(data):
+            added, removed = (self._added, self._removed) if followed_id > 0 else (self._removed, self._added)
+            added.setdefault(follower_id, set()).add(abs(followed_id))
+            removed.get(follower_id, set()).discard(abs(followed_id))
+            changed_user_ids.add(follower_id)
+        self._delta_log_offset += len(data)
+        return changed_user_ids
+
+    def get_user_ids(self):
+        """Sorted ids of users who follow anyone"""
+        return sorted(set(self.user_ids.tolist()).union(self._added))
+
+    def _get_row(self, user_id):
+        index = bisect_left(self.user_ids, user_id)
+        if index < len(self.user_ids) and self.user_ids[index] == user_id:
+            return self.offsets[index], self.offsets[index + 1]
+        return 0, 0
+
+    def follows(self, user_id, followed_id):
+        if followed_id in self._added.get(user_id, ()):
+            return True
+        if followed_id in self._removed.get(user_id, ()):
+            return False
+
+        start, end = self._get_row(user_id)
+        index = bisect_left(self.followed_ids, followed_id, start, end)
+        return index < end and self.followed_ids[index] == followed_id
+
+    def get_followed_ids(self, user_id):
+        """Sorted ids of users followed by the user"""
+        start, end = self._get_row(user_id)
+        followed_ids = set(self.followed_ids[start:end].tolist())
+        followed_ids -= self._removed.get(user_id, set())
+        followed_ids |= self._added.get(user_id, set())
+        return sorted(followed_ids)
+
+    def get_followed_by_followed(self, user_id):
+        """{user_id: how many of the followed users follow them} without the user and whom the user follows"""
+        followed_ids = self.get_followed_ids(user_id)
+        counts = {}
+        for followed_id in followed_ids:
+            for second_id in self.get_followed_ids(followed_id):
+                counts[second_id] = counts.get(second_id, 0) + 1
+
+        for excluded_id in [user_id, *followed_ids]:
+            counts.pop(excluded_id, None)
+        return counts
+
+    def is_mutual(self, user_id, other_id):
+        return self.follows(user_id, other_id) and self.follows(other_id, user_id)
+
+
+_graph = None
+_checked_at = 0
+
+
+def get_follow_graph(refresh_interval=1.0):
+    """
+    Graph of the current generation shared by the process, None until the first snapshot is built.
+    The generation and the delta log are checked at most once per refresh_interval seconds.
+    """
+    global _graph, _checked_at
+    now = time.monotonic()
+    if _graph is not None and now - _checked_at < refresh_interval:
+        return _graph
+
+    _checked_at = now
+    root = settings.FOLLOW_GRAPH_ROOT
+    generation = get_current_generation(root)
+    if generation is None:
+        _graph = None
+    elif _graph is None or _graph.root != root or _graph.generation != generation:
+        try:
+            _graph = FollowGraph(root, generation)
+        except FileNotFoundError:
+            # the new generation is being written, the previous one is still fine
+            pass
+    else:
+        _graph.apply_delta_log()
+    return _graph
@@ -2,6 +2,7 @@ import re
 
 from django import forms
 from django.contrib.auth.forms import UserChangeForm, UserCreationForm
+from django.db import transaction
 from django.forms import ModelForm, ClearableFileInput, CharField, Textarea, EmailInput
 
 from .models import *
@@ -24,9 +25,11 @@ class TagFormMixin:
         tags = self.cleaned_data.get('name', None).lower()
         if tags:
             if self.multiple_tags_allowed:
-                tags = re.findall(r'#(\w{2,})\b', tags)
+                tags = list(dict.fromkeys(re.findall(r'#(\w{2,})\b', tags)))
                 for tag in tags:
                     self.validate_tag_length(tag)
+                if len(tags) > Post.max_tags_count:
+                    self.add_error('name', f'Post can have up to {Post.max_tags_count} tags.')
             else:
                 tags = re.search(r'#(\w{2,})\b', tags)
                 if tags:
@@ -36,21 +39,10 @@ class TagFormMixin:
                 self.add_error('name', 'Wrong tag format. Tags must start with "#" and contain at least 2 characters.')
         return tags
 
-    def save_one_tag(self, tag: str, post):
-        if Tag.objects.filter(name=tag).exists():
-            tag = Tag.objects.get(name=tag)
-        else:
-            tag = Tag.objects.create(name=tag)
-
-        try:
-            tag.posts.add(post)
-        except ValidationError:
+    def save_tags(self, tags: list, post):
+        if Tag.objects.add_to_post(post, tags):
             self.add_error('name', f'Post can have up to {Post.max_tags_count} tags.')
 
-    def save_multiple_tags(self, tags: list, post):
-        for _tag in tags:
-            self.save_one_tag(tag=_tag, post=post)
-
     def save(self, post, *args, **kwargs):
         if not isinstance(post, Post):
             raise ValidationError('Please attach post to tags')
@@ -61,9 +53,9 @@ class TagFormMixin:
             return
 
         if self.multiple_tags_allowed:
-            self.save_multiple_tags(tags=parsed_tags, post=post)
+            self.save_tags(tags=parsed_tags, post=post)
         else:
-            self.save_one_tag(tag=parsed_tags, post=post)
+            self.save_tags(tags=[parsed_tags], post=post)
 
 
 class MultipleTagsForm(TagFormMixin, forms.Form):
@@ -107,6 +99,10 @@ class ImageForm(ModelForm):
             'image': ClearableFileInput(attrs={'multiple': True}),
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['image'].required = True
+
     def clean_image(self):
         if len(self.files.getlist('image')) > 10:
             self.add_error('image', f'Post can have up to {Images.max_count_images_in_post} images.')
@@ -116,8 +112,21 @@ class ImageForm(ModelForm):
         if not post:
             raise ValidationError('Please attach post to images')
 
-        for image in self.files.getlist('image'):
-            Images.objects.create(image=image, post=post)
+        # images are thumbnailed and uploaded to the cloud by the background worker
+        images = []
+        try:
+            for file in self.files.getlist('image'):
+                image = Images(status=Images.PROCESSING, post=post)
+                image.raw_image.save(file.name, file, save=False)
+                images.append(image)
+            with transaction.atomic():
+                post.reserve_slots(images=len(images))
+                Images.objects.bulk_create(images)
+        except Exception:
+            for image in images:
+                image.raw_image.delete(save=False)
+            raise
+        return images
 
 
 class CustomUserCreationForm(ModelForm):
@@ -0,0 +1,275 @@
+import hashlib
+import mimetypes
+import os
+import re
+from functools import lru_cache
+from itertools import groupby
+from operator import attrgetter
+
+import cloudinary
+import cloudinary.api
+import cloudinary.uploader
+from PIL import Image
+from cloudinary.models import CLOUDINARY_FIELD_DB_RE
+from django import forms
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.signals import setting_changed
+from django.db import models
+from django.dispatch import receiver
+from django.http import Http404, HttpResponse
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+from django.views.static import serve
+
+from .thumbnails import make_thumbnail
+
+# a page builds a URL per rendition of every image and avatar on it, this keeps many pages worth of them
+IMAGE_URL_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=None)
+def get_image_storage():
+    return import_string(settings.IMAGE_STORAGE_BACKEND)()
+
+
+@receiver(setting_changed)
+def reset_image_storage(setting, **kwargs):
+    if setting.startswith('IMAGE_STORAGE'):
+        get_image_storage.cache_clear()
+        _build_url.cache_clear()
+
+
+@lru_cache(maxsize=IMAGE_URL_CACHE_SIZE)
+def _build_url(name, transformation):
+    return get_image_storage().url(name, **dict(transformation))
+
+
+def get_image_url_cache_info():
+    """Hits, misses and size of the process-wide memo of image URLs"""
+    return _build_url.cache_info()
+
+
+def get_content_hash(file):
+    """sha256 of the file, which is read in chunks, so a big upload isn't loaded into memory"""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+class StoredImage:
+    """Image kept by the image storage, the value of ImageStorageField"""
+
+    def __init__(self, name, metadata=None):
+        self.name = name
+        self.metadata = metadata or {}
+
+    def __str__(self):
+        return self.name
+
+    def __len__(self):
+        return len(self.name)
+
+    def __eq__(self, other):
+        return isinstance(other, StoredImage) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    @property
+    def url(self):
+        return _build_url(self.name, ())
+
+    def build_url(self, **transformation):
+        """URLs are memoized, building a Cloudinary URL parses the config and formats strings every time"""
+        return _build_url(self.name, tuple(sorted(transformation.items())))
+
+
+class CloudinaryImageStorage:
+    """Images are kept and transformed by Cloudinary, names are the db values of CloudinaryField"""
+    max_delete_batch_size = 100  # limit of the Admin API
+
+    def save(self, file, **options):
+        resource = cloudinary.uploader.upload_resource(file, type='upload', resource_type='image', **options)
+        return StoredImage(resource.get_prep_value(), metadata=resource.metadata)
+
+    def url(self, name, **transformation):
+        return self._get_resource(name).build_url(**transformation)
+
+    def delete(self, names):
+        """Images are deleted in batches by the Admin API, images which are already deleted are skipped"""
+        resources = sorted((self._get_resource(name) for name in names),
+                           key=lambda resource: (resource.type, resource.resource_type))
+        for (upload_type, resource_type), group in groupby(resources, key=attrgetter('type', 'resource_type')):
+            public_ids = [resource.public_id for resource in group]
+            for start in range(0, len(public_ids), self.max_delete_batch_size):
+                cloudinary.api.delete_resources(public_ids[start:start + self.max_delete_batch_size],
+                                                type=upload_type, resource_type=resource_type, invalidate=True)
+
+    @staticmethod
+    def _get_resource(name):
+        match = re.match(CLOUDINARY_FIELD_DB_RE, name)
+        return cloudinary.CloudinaryResource(type=match.group('type') or 'upload',
+                                             resource_type=match.group('resource_type') or 'image',
+                                             version=match.group('version'),
+                                             public_id=match.group('public_id'),
+                                             format=match.group('format'))
+
+
+class LocalImageStorage:
+    """
+    Images are kept under settings.IMAGE_STORAGE_ROOT in a sharded content-addressed layout,
+    ab/cd/abcd...ef.jpg where the name is sha256 of the file. Eager transformations are rendered
+    next to the image at save, other transformations aren't supported.
+    """
+    pillow_formats = {'jpg': 'jpeg'}
+
+    def __init__(self):
+        self.storage = FileSystemStorage(location=settings.IMAGE_STORAGE_ROOT, base_url=settings.IMAGE_STORAGE_URL)
+
+    def save(self, file, eager=(), **options):
+        """Cloud upload options, like folder or public_id, don't apply to content-addressed names"""
+        digest = get_content_hash(file)
+        with Image.open(file) as image:
+            width, height = image.size
+            extension = 'jpg' if image.format == 'JPEG' else image.format.lower()
+
+        name = f'{digest[:2]}/{digest[2:4]}/{digest}.{extension}'
+        if not self.storage.exists(name):
+            name = self.storage.save(name, File(file))
+
+        for transformation in eager:
+            rendition_name = self.get_rendition_name(name, transformation)
+            if not self.storage.exists(rendition_name):
+                file.seek(0)
+                self.storage.save(rendition_name, File(self._render(file, (width, height), transformation)))
+
+        return StoredImage(name, metadata={'width': width, 'height': height})
+
+    def url(self, name, **transformation):
+        return self.storage.url(self.get_rendition_name(name, transformation) if transformation else name)
+
+    def delete(self, names):
+        """Renditions are removed together with the image"""
+        for name in names:
+            directory, filename = os.path.split(name)
+            if not self.storage.exists(directory):
+                continue
+
+            stem = os.path.splitext(filename)[0]
+            for stored_name in self.storage.listdir(directory)[1]:
+                if stored_name.startswith(stem):
+                    self.storage.delete(os.path.join(directory, stored_name))
+
+    def serve(self, request, name):
+        """
+        Behind nginx (settings.IMAGE_STORAGE_ACCEL_REDIRECT_URL) the file is sent by nginx itself
+        with sendfile, otherwise it's streamed by Django, which is only fine for development.
+        """
+        if not self.storage.exists(name):
+            raise Http404
+
+        if settings.IMAGE_STORAGE_ACCEL_REDIRECT_URL:
+            response = HttpResponse(content_type=mimetypes.guess_type(name)[0])
+            response['X-Accel-Redirect'] = settings.IMAGE_STORAGE_ACCEL_REDIRECT_URL + name
+        else:
+            response = serve(request, name, document_root=self.storage.location)
+
+        # names are content-addressed, so the file behind a name never changes
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+    @staticmethod
+    def get_rendition_name(name, transformation):
+        stem, extension = os.path.splitext(name)
+        key = '_'.join(f'{option}-{value}' for option, value in sorted(transformation.items()) if option != 'format')
+        return f'{stem}_{key}.{transformation.get("format", extension[1:])}'
+
+    def _render(self, file, source_size, transformation):
+        """Supports 'limit' and 'fill' crops of Cloudinary"""
+        width = transformation['width']
+        height = transformation.get('height') or max(1, round(source_size[1] * width / source_size[0]))
+        image_format = transformation.get('format', 'jpg')
+
+        rendition, _ = make_thumbnail(file, (width, height), crop=transformation.get('crop') == 'fill',
+                                      image_format=self.pillow_formats.get(image_format, image_format))
+        return rendition
+
+
+class RawImageStorage(FileSystemStorage):
+    """
+    Original uploads waiting for the image worker are kept under settings.RAW_IMAGE_ROOT, outside MEDIA_ROOT.
+    They still carry their EXIF metadata, GPS position included, so they must never be served.
+    """
+
+    @cached_property
+    def base_location(self):
+        return settings.RAW_IMAGE_ROOT
+
+    def _clear_cached_properties(self, setting, **kwargs):
+        super()._clear_cached_properties(setting, **kwargs)
+        if setting == 'RAW_IMAGE_ROOT':
+            self.__dict__.pop('base_location', None)
+            self.__dict__.pop('location', None)
+
+
+class ImageStorageField(models.CharField):
+    """
+    Image kept by the configured image storage (settings.IMAGE_STORAGE_BACKEND), the db keeps its name.
+    Upload options may be callables of the model instance, like upload_to of FileField.
+    """
+    upload_options = ('folder', 'public_id', 'use_filename', 'eager')
+
+    def __init__(self, *args, width_field=None, height_field=None, **kwargs):
+        self.width_field = width_field
+        self.height_field = height_field
+        self.options = {option: kwargs.pop(option) for option in self.upload_options if option in kwargs}
+        kwargs['max_length'] = 255
+        super().__init__(*args, **kwargs)
+
+    def from_db_value(self, value, expression, connection):
+        return StoredImage(value) if value else value
+
+    def to_python(self, value):
+        if not value or isinstance(value, (StoredImage, UploadedFile)):
+            return value
+        return StoredImage(value)
+
+    def get_prep_value(self, value):
+        if not value:
+            return None if self.null else ''
+        if isinstance(value, StoredImage):
+            return value.name
+        return value
+
+    def run_validators(self, value):
+        # max_length is the limit of the stored name, not of an upload
+        if not isinstance(value, UploadedFile):
+            super().run_validators(value)
+
+    def upload(self, model_instance, file):
+        """Saves the file to the image storage with upload options of the model instance"""
+        options = {option: option_value(model_instance) if callable(option_value) else option_value
+                   for option, option_value in self.options.items()}
+        return get_image_storage().save(file, **options)
+
+    def pre_save(self, model_instance, add):
+        value = super().pre_save(model_instance, add)
+        if isinstance(value, UploadedFile):
+            value = self.upload(model_instance, value)
+            setattr(model_instance, self.attname, value)
+            if self.width_field:
+                setattr(model_instance, self.width_field, value.metadata.get('width'))
+            if self.height_field:
+                setattr(model_instance, self.height_field, value.metadata.get('height'))
+
+        return self.get_prep_value(value)
+
+    def formfield(self, **kwargs):
+        # CharField would build a text input
+        return models.Field.formfield(self, **{'form_class': forms.ImageField, 'max_length': self.max_length,
+                                               **kwargs})
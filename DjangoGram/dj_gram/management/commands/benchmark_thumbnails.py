@@ -0,0 +1,72 @@
+import os
+import resource
+import tempfile
+import time
+from io import BytesIO
+from multiprocessing import get_context
+
+from PIL import Image
+from django.core.management.base import BaseCommand
+
+from dj_gram.thumbnails import ACCEPTABLE_IMAGE_SIZE, make_thumbnail
+
+
+def legacy_make_thumbnail(file, size):
+    """Thumbnailing before decode-scaling, the baseline of the benchmark"""
+    image = Image.open(file).convert('RGB')
+    image.thumbnail(size)
+    temp = BytesIO()
+    image.save(temp, 'jpeg')
+    return temp, temp.tell()
+
+
+ENGINES = {'legacy': legacy_make_thumbnail, 'draft': make_thumbnail}
+
+
+def create_photo(path, megapixels):
+    """Noise doesn't compress, so decoding it costs as much as decoding a real photo"""
+    width = int((megapixels * 10 ** 6 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    Image.effect_noise((width, height), 64).convert('RGB').save(path, 'jpeg', quality=90)
+
+
+def measure(engine, path, size):
+    """
+    Runs in a fresh process, so its peak RSS is the interpreter plus this one thumbnail.
+    The module must stay importable without Django apps being loaded.
+    """
+    start = time.perf_counter()
+    with open(path, 'rb') as file:
+        ENGINES[engine](file, size)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return elapsed, peak / 1024  # ru_maxrss is in KiB on Linux
+
+
+class Command(BaseCommand):
+    help = 'Compares time per megapixel and peak RSS of the legacy and the decode-scaled thumbnailing ' \
+           'on synthetic JPEG photos.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--megapixels', type=int, nargs='+', default=[2, 12, 24, 48])
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per photo, the best time is reported.')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"MP":>4}{"engine":>8}{"ms/MP":>10}{"peak RSS MB":>14}')
+
+        with tempfile.TemporaryDirectory() as directory:
+            for megapixels in options['megapixels']:
+                path = os.path.join(directory, f'{megapixels}mp.jpg')
+                # every task gets a new process, otherwise the peak RSS of a previous task is reported.
+                # Spawned processes inherit the peak RSS of this one, so photos aren't created here either.
+                with get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+                    pool.apply(create_photo, (path, megapixels))
+                    results = {engine: [pool.apply(measure, (engine, path, ACCEPTABLE_IMAGE_SIZE))
+                                        for _ in range(options['repeat'])]
+                               for engine in ENGINES}
+
+                for engine, runs in results.items():
+                    ms_per_megapixel = min(elapsed for elapsed, _ in runs) * 1000 / megapixels
+                    peak = max(peak for _, peak in runs)
+                    self.stdout.write(f'{megapixels:>4}{engine:>8}{ms_per_megapixel:>10.2f}{peak:>14.1f}')
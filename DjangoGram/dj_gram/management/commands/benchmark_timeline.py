@@ -0,0 +1,103 @@
+import random
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from dj_gram.models import CustomUser, Follow, Post, TimelineEntry
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compares read latency and write amplification of pure fan-out and hybrid timelines ' \
+           'on synthetic data. All the data is created in a transaction which is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--celebrities', type=int, default=2,
+                            help='Authors followed by every user.')
+        parser.add_argument('--authors', type=int, default=50,
+                            help='Regular authors, every user follows --follows of them.')
+        parser.add_argument('--follows', type=int, default=10)
+        parser.add_argument('--posts', type=int, default=5, help='Posts created by every author.')
+        parser.add_argument('--reads', type=int, default=200, help='Timeline pages read.')
+        parser.add_argument('--page-size', type=int, default=3)
+        parser.add_argument('--threshold', type=int,
+                            help='Followers threshold of the hybrid mode, half of --users by default.')
+
+    def handle(self, *args, **options):
+        self.options = options
+        default_threshold = TimelineEntry.fan_out_followers_threshold
+        hybrid_threshold = options['threshold'] or options['users'] // 2
+        results = {}
+
+        try:
+            for mode, threshold in (('fan-out', options['users']), ('hybrid', hybrid_threshold)):
+                TimelineEntry.fan_out_followers_threshold = threshold
+                results[mode] = self._run()
+        finally:
+            TimelineEntry.fan_out_followers_threshold = default_threshold
+
+        self.stdout.write(f'{"mode":<10}{"rows/post":>12}{"write ms/post":>16}{"read ms/page":>15}')
+        for mode, (rows_per_post, write_ms, read_ms) in results.items():
+            self.stdout.write(f'{mode:<10}{rows_per_post:>12.1f}{write_ms:>16.2f}{read_ms:>15.2f}')
+
+    def _run(self):
+        try:
+            with transaction.atomic():
+                users, authors = self._create_graph()
+                result = self._measure(users, authors)
+                raise Rollback
+        except Rollback:
+            pass
+
+        # ids of rolled back authors will be reused, so their cached posts must go too
+        cache.delete_many([TimelineEntry.objects.author_posts_cache_key(author.id) for author in authors])
+        return result
+
+    def _create_graph(self):
+        options = self.options
+        users = CustomUser.objects.bulk_create(
+            [CustomUser(email=f'timeline_benchmark_{i}@benchmark.local') for i in range(options['users'])])
+        celebrities = users[:options['celebrities']]
+        authors = users[options['celebrities']:options['celebrities'] + options['authors']]
+
+        follows = []
+        for user in users:
+            followed = celebrities + random.sample(authors, min(options['follows'], len(authors)))
+            follows.extend(Follow(user=user, followed_id=author) for author in followed if author != user)
+        Follow.objects.bulk_create(follows)
+
+        followers = dict(Follow.objects.filter(followed_id__in=celebrities + authors)
+                         .values('followed_id').annotate(count=Count('id')).values_list('followed_id', 'count'))
+        for author in celebrities + authors:
+            author.followed_count = followers.get(author.id, 0)
+        CustomUser.objects.bulk_update(celebrities + authors, ['followed_count'])
+
+        return users, celebrities + authors
+
+    def _measure(self, users, authors):
+        options = self.options
+        posts_count = 0
+
+        start = time.perf_counter()
+        for _ in range(options['posts']):
+            for author in authors:
+                TimelineEntry.objects.fan_out(Post.objects.create(user=author))
+                posts_count += 1
+        write_ms = (time.perf_counter() - start) * 1000 / posts_count
+        rows_per_post = TimelineEntry.objects.count() / posts_count
+
+        readers = random.choices(users, k=options['reads'])
+        start = time.perf_counter()
+        for reader in readers:
+            post_ids = TimelineEntry.objects.get_page_post_ids(reader, limit=options['page_size'] + 1)
+            list(Post.objects.for_cards().filter(id__in=post_ids))
+        read_ms = (time.perf_counter() - start) * 1000 / len(readers)
+
+        return rows_per_post, write_ms, read_ms
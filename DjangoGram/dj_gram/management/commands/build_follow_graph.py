@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from dj_gram import follow_graph
+from dj_gram.models import Follow
+
+
+class Command(BaseCommand):
+    help = 'Builds a new memory-mapped snapshot of the follow graph, see dj_gram/follow_graph.py. ' \
+           'Follows committed later are applied from the delta log until the next build.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Follows read and written at once.')
+
+    def handle(self, *args, **options):
+        edges = Follow.objects.order_by('user_id', 'followed_id_id').values_list('user_id', 'followed_id_id') \
+            .iterator(chunk_size=options['chunk_size'])
+        generation, users, edge_count = follow_graph.write_snapshot(settings.FOLLOW_GRAPH_ROOT, edges,
+                                                                    options['chunk_size'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Built generation {generation} of {users} users and {edge_count} follows.'))
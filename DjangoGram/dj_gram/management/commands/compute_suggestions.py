@@ -0,0 +1,77 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from dj_gram import follow_graph
+from dj_gram.follow_graph import FollowGraph
+from dj_gram.models import CustomUser, Follow, FollowSuggestion
+
+
+class Command(BaseCommand):
+    help = 'Precomputes follow suggestions of all users from the follow graph snapshot, which is built ' \
+           'when it is missing or older than --build-interval. With --loop suggestions of users who follow ' \
+           'or unfollow someone, and of their followers, are refreshed from the delta log and all suggestions ' \
+           'are recomputed when a new snapshot is built.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Users refreshed per transaction.')
+        parser.add_argument('--loop', action='store_true', help='Keep refreshing suggestions.')
+        parser.add_argument('--sleep', type=float, default=5, help='Seconds between polls of the delta log.')
+        parser.add_argument('--build-interval', type=float, default=3600,
+                            help='Seconds after which a new snapshot is built, 0 builds only a missing one. '
+                                 'A new snapshot also starts a new delta log, so the log stays short.')
+        parser.add_argument('--max-followers', type=int, default=10000,
+                            help='Followers of accounts with more followers are refreshed by the next build only.')
+
+    def handle(self, *args, **options):
+        root = settings.FOLLOW_GRAPH_ROOT
+        graph = None
+        while True:
+            generation = follow_graph.get_current_generation(root)
+            if self._needs_build(root, generation, options['build_interval']):
+                call_command('build_follow_graph', stdout=self.stdout)
+                generation = follow_graph.get_current_generation(root)
+
+            if graph is None or graph.generation != generation:
+                try:
+                    graph = FollowGraph(root, generation)
+                except FileNotFoundError:
+                    pass  # the snapshot is being written
+                else:
+                    self._refresh(graph, graph.get_user_ids(), options['chunk_size'])
+            else:
+                user_ids = graph.apply_delta_log()
+                # friends of friends of the followers have changed too
+                user_ids |= self._get_follower_ids(user_ids, options['max_followers'])
+                self._refresh(graph, sorted(user_ids), options['chunk_size'])
+
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
+
+    @staticmethod
+    def _needs_build(root, generation, build_interval):
+        if generation is None:
+            return True
+        if not build_interval:
+            return False
+        try:
+            built_at = os.path.getmtime(follow_graph.get_snapshot_path(root, generation))
+        except FileNotFoundError:
+            return False  # the snapshot is being written
+        return time.time() - built_at > build_interval
+
+    @staticmethod
+    def _get_follower_ids(user_ids, max_followers):
+        followed_ids = CustomUser.objects.filter(pk__in=user_ids, followed_count__lte=max_followers) \
+            .values_list('pk', flat=True)
+        return set(Follow.objects.filter(followed_id__in=followed_ids).values_list('user_id', flat=True))
+
+    def _refresh(self, graph, user_ids, chunk_size):
+        for start in range(0, len(user_ids), chunk_size):
+            FollowSuggestion.objects.refresh(graph, user_ids[start:start + chunk_size])
+        if user_ids:
+            self.stdout.write(f'Refreshed suggestions of {len(user_ids)} users.')
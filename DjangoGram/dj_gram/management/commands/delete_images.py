@@ -0,0 +1,34 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from dj_gram.models import ImageDeletion
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Deletes images scheduled for deletion from the image storage.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Images per cloud request.')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new deletions.')
+        parser.add_argument('--sleep', type=float, default=2, help='Seconds between polls when idle.')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                deleted = ImageDeletion.objects.drain(options['batch_size'])
+            except Exception:
+                # the batch is retried later, other batches may be due already
+                logger.exception('Deleting images failed')
+                deleted = None
+
+            if deleted:
+                self.stdout.write(f'Deleted {deleted} images.')
+
+            if not options['loop']:
+                break
+            if not deleted:
+                time.sleep(options['sleep'])
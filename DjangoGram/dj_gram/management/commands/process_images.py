@@ -0,0 +1,55 @@
+import logging
+import time
+from itertools import groupby
+from operator import attrgetter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from dj_gram.models import Images, Post
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Thumbnails uploaded images, uploads them to the cloud and marks them ready.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10, help='Posts claimed per batch.')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new images.')
+        parser.add_argument('--sleep', type=float, default=2, help='Seconds between polls when idle.')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = self._process_batch(options['batch_size'])
+            if processed:
+                self.stdout.write(f'Processed {processed} images.')
+
+            if not options['loop']:
+                break
+            if not processed:
+                time.sleep(options['sleep'])
+
+    @staticmethod
+    def _process_batch(batch_size):
+        """
+        Posts with pending images are claimed whole, locked posts are skipped,
+        so several workers can drain the queue concurrently without splitting a post between them.
+        Images of one post are uploaded together and fail together.
+        """
+        with transaction.atomic():
+            post_ids = list(Post.objects.select_for_update(skip_locked=True)
+                            .filter(pk__in=Images.objects.filter(status=Images.PROCESSING).values('post_id'))
+                            .order_by('id').values_list('id', flat=True)[:batch_size])
+            images = list(Images.objects.filter(post_id__in=post_ids, status=Images.PROCESSING)
+                          .order_by('post_id', 'id'))
+
+            for post_id, post_images in groupby(images, key=attrgetter('post_id')):
+                post_images = list(post_images)
+                try:
+                    Images.objects.process(post_images)
+                except Exception:
+                    logger.exception('Processing images of post %s failed', post_id)
+                    Images.objects.fail(post_images)
+
+        return len(images)
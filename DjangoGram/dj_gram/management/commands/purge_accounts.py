@@ -0,0 +1,43 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from dj_gram.models import CustomUser
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Deletes accounts scheduled for deletion together with their posts, votes and follows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Rows deleted per transaction.')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new deletions.')
+        parser.add_argument('--sleep', type=float, default=10, help='Seconds between polls when idle.')
+
+    def handle(self, *args, **options):
+        while True:
+            users = list(CustomUser.objects.filter(deletion_requested_at__isnull=False)
+                         .order_by('deletion_requested_at'))
+            for user in users:
+                self._purge(user, options['chunk_size'])
+
+            if not options['loop']:
+                break
+            if not users:
+                time.sleep(options['sleep'])
+
+    def _purge(self, user, chunk_size):
+        user_id = user.pk
+        deleted = {}
+        try:
+            for what, count in CustomUser.objects.purge(user, chunk_size):
+                deleted[what] = deleted.get(what, 0) + count
+                self.stdout.write(f'User {user_id}: deleted {deleted[what]} {what}.')
+        except Exception:
+            # chunks which are already deleted stay deleted, the purge resumes on the next poll
+            logger.exception('Purging user %s failed', user_id)
+            return
+
+        self.stdout.write(f'Purged user {user_id}.')
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from dj_gram.models import Images, Post
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds image_count and tag_count of posts from their images and tags in chunks. ' \
+           'Posts created before the counters were introduced start at zero, so run it by hand once after ' \
+           'the migration which adds them. It scans every post, so it is not part of the deploy.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of posts reconciled in one transaction.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = 0
+        checked = fixed = 0
+
+        while True:
+            with transaction.atomic():
+                posts = list(Post.objects.select_for_update()
+                             .filter(id__gt=last_id)
+                             .order_by('id')
+                             .only('id', 'image_count', 'tag_count')[:chunk_size])
+                if not posts:
+                    break
+
+                last_id = posts[-1].id
+                fixed += self._reconcile_chunk(posts)
+                checked += len(posts)
+
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} posts, fixed {fixed} counters.'))
+
+    @staticmethod
+    def _reconcile_chunk(posts):
+        post_ids = [post.id for post in posts]
+        image_counts = dict(Images.objects.filter(post_id__in=post_ids)
+                            .values('post_id').annotate(count=Count('id')).values_list('post_id', 'count'))
+        tag_counts = dict(Post.tags.through.objects.filter(post_id__in=post_ids)
+                          .values('post_id').annotate(count=Count('id')).values_list('post_id', 'count'))
+
+        drifted = []
+        for post in posts:
+            # legacy posts may be over the limits which check constraints enforce, such posts are just full
+            counts = (min(image_counts.get(post.id, 0), Post.max_images_count),
+                      min(tag_counts.get(post.id, 0), Post.max_tags_count))
+            if (post.image_count, post.tag_count) != counts:
+                post.image_count, post.tag_count = counts
+                drifted.append(post)
+
+        Post.objects.bulk_update(drifted, ['image_count', 'tag_count'])
+        return len(drifted)
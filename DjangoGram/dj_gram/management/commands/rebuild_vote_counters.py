@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q
+
+from dj_gram.models import Post, Vote
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds denormalized like/dislike counters of posts from the Vote table in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of posts reconciled in one transaction.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = 0
+        checked = fixed = 0
+
+        while True:
+            with transaction.atomic():
+                posts = list(Post.objects.select_for_update()
+                             .filter(id__gt=last_id)
+                             .order_by('id')
+                             .only('id', 'like_count', 'dislike_count')[:chunk_size])
+                if not posts:
+                    break
+
+                last_id = posts[-1].id
+                fixed += self._reconcile_chunk(posts)
+                checked += len(posts)
+
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} posts, fixed {fixed} counters.'))
+
+    @staticmethod
+    def _reconcile_chunk(posts):
+        """Locks only the rows of the chunk, so voting on other posts is not blocked."""
+
+        counts = Vote.objects.filter(post_id__in=[post.id for post in posts]) \
+            .values('post_id') \
+            .annotate(likes=Count('id', filter=Q(vote=True)), dislikes=Count('id', filter=Q(vote=False)))
+        counts = {row['post_id']: (row['likes'], row['dislikes']) for row in counts}
+
+        drifted = []
+        for post in posts:
+            likes, dislikes = counts.get(post.id, (0, 0))
+            if (post.like_count, post.dislike_count) != (likes, dislikes):
+                post.like_count, post.dislike_count = likes, dislikes
+                drifted.append(post)
+
+        Post.objects.bulk_update(drifted, ['like_count', 'dislike_count'])
+        return len(drifted)
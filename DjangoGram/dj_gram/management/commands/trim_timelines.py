@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from dj_gram.models import CustomUser, Follow, TimelineEntry
+
+
+class Command(BaseCommand):
+    help = 'Caps precomputed timelines at TimelineEntry.max_entries_per_user entries. Fan-out keeps them capped, ' \
+           'this repairs timelines after a backfill or a change of the cap. ' \
+           'With --backfill rebuilds timelines of all users from their follows first.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', action='store_true',
+                            help='Backfill timelines from follows and own posts before trimming.')
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            self._backfill()
+
+        overflowed_user_ids = TimelineEntry.objects.values('user_id') \
+            .annotate(entries=Count('id')) \
+            .filter(entries__gt=TimelineEntry.max_entries_per_user) \
+            .values_list('user_id', flat=True)
+
+        trimmed = 0
+        for user_id in overflowed_user_ids:
+            TimelineEntry.objects.trim(user_id)
+            trimmed += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Trimmed {trimmed} timelines.'))
+
+    def _backfill(self):
+        for user in CustomUser.objects.only('id').iterator():
+            TimelineEntry.objects.backfill(user=user, author=user)
+
+        for follow in Follow.objects.select_related('user', 'followed_id').iterator():
+            TimelineEntry.objects.backfill(user=follow.user, author=follow.followed_id)
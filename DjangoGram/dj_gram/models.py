@@ -1,31 +1,172 @@
+import heapq
 import os
-import sys
-from io import BytesIO
+import random
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
 
-import cloudinary
-from PIL import Image
-from cloudinary.models import CloudinaryField
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models.signals import m2m_changed, pre_delete
+from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Greatest
+from django.db.models.signals import m2m_changed, pre_delete, post_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 
 from DjangoGram import settings
+from . import follow_graph
+from .image_storage import ImageStorageField, RawImageStorage, StoredImage, get_content_hash, get_image_storage
+from .thumbnails import ACCEPTABLE_IMAGE_SIZE, make_thumbnail
 
 
 class ImageThumbnailMixin:
+    acceptable_image_size = ACCEPTABLE_IMAGE_SIZE
+    crop_thumbnail = False
+
+    @classmethod
+    def make_thumbnail(cls, image_field):
+        image_field.file, image_field.size = make_thumbnail(image_field, cls.acceptable_image_size,
+                                                            crop=cls.crop_thumbnail)
+
+
+class ImageDeletionManager(models.Manager):
+    def schedule(self, names):
+        """
+        Records stored images to delete in the current transaction, the delete_images worker deletes them
+        once it's committed, so no cloud request is made while rows are locked.
+        """
+        self.bulk_create([self.model(name=name) for name in names])
+
+    def drain(self, batch_size=100):
+        """
+        Deletes a batch of due images from the image storage, failed batches are retried with exponential backoff.
+        Claimed rows are postponed for lease_time instead of being locked during the cloud request,
+        so a crashed worker doesn't lose them. Returns the number of claimed rows.
+        """
+        with transaction.atomic():
+            deletions = list(self.select_for_update(skip_locked=True)
+                             .filter(next_attempt_at__lte=timezone.now())
+                             .order_by('next_attempt_at')[:batch_size])
+            self.filter(pk__in=[deletion.pk for deletion in deletions]).update(
+                next_attempt_at=timezone.now() + timedelta(seconds=self.model.lease_time))
+
+        if not deletions:
+            return 0
+
+        names = {deletion.name for deletion in deletions}
+        try:
+            # a content-addressed storage gives re-uploaded content the name of the deleted image
+            get_image_storage().delete(names - self.get_referenced_names(names))
+        except Exception:
+            for deletion in deletions:
+                deletion.attempts += 1
+                deletion.next_attempt_at = timezone.now() + deletion.get_retry_delay()
+            self.bulk_update(deletions, ['attempts', 'next_attempt_at'])
+            raise
+
+        self.filter(pk__in=[deletion.pk for deletion in deletions]).delete()
+        return len(deletions)
+
     @staticmethod
-    def make_thumbnail(image_field):
-        acceptable_image_size = (1280, 720)
-        image = Image.open(image_field).convert('RGB')
-        image.thumbnail(acceptable_image_size)
-        temp = BytesIO()  # because thumbnail must be saved in binary mode
-        image.save(temp, 'jpeg')
-        temp.seek(0)  # sets the file's start position
-        image_field.file = temp
-        image_field.size = sys.getsizeof(temp)
+    def get_referenced_names(names):
+        """Names which are still kept by a row, every column is indexed for these lookups"""
+        names = list(names)
+        querysets = [ImageAsset.objects.filter(image__in=names).values_list('image', flat=True),
+                     Images.objects.filter(image__in=names).values_list('image', flat=True),
+                     CustomUser.objects.filter(avatar__in=names).values_list('avatar', flat=True)]
+        return {image.name for queryset in querysets for image in queryset}
+
+
+class ImageDeletion(models.Model):
+    """Outbox of stored images to delete from the image storage"""
+    name = models.CharField(max_length=255)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    lease_time = 300  # seconds a worker has to delete a claimed batch
+    retry_delay = 30
+    max_retry_delay = 3600
+
+    objects = ImageDeletionManager()
+
+    def get_retry_delay(self):
+        return timedelta(seconds=min(self.retry_delay * 2 ** (self.attempts - 1), self.max_retry_delay))
+
+
+class ImageAssetManager(models.Manager):
+    def acquire(self, kind, file, upload):
+        """
+        Returns the asset of the file content with one more reference to it.
+        upload(file) -> StoredImage thumbnails and uploads the file, it's only called
+        when the same content wasn't uploaded before.
+        """
+        content_hash = get_content_hash(file)
+        if self.filter(kind=kind, content_hash=content_hash).update(ref_count=models.F('ref_count') + 1):
+            return self.get(kind=kind, content_hash=content_hash)
+
+        asset = self.register(kind, content_hash, upload(file))
+        self.add_references({asset.pk: 1})
+        asset.ref_count += 1
+        return asset
+
+    def register(self, kind, content_hash, stored_image):
+        """Creates an unreferenced asset of an uploaded image or returns the asset of the same content"""
+        try:
+            with transaction.atomic():
+                return self.create(kind=kind, content_hash=content_hash, image=stored_image,
+                                   width=stored_image.metadata.get('width'),
+                                   height=stored_image.metadata.get('height'))
+        except IntegrityError:
+            # the same content was uploaded concurrently, so this upload is a duplicate
+            asset = self.get(kind=kind, content_hash=content_hash)
+            if asset.image != stored_image:
+                ImageDeletion.objects.schedule([stored_image.name])
+            return asset
+
+    def add_references(self, references):
+        """references is {asset_id: count}"""
+        for asset_id, count in references.items():
+            self.filter(pk=asset_id).update(ref_count=models.F('ref_count') + count)
+
+    def release(self, asset_ids):
+        """
+        Drops a reference per asset id, assets which aren't referenced anymore are deleted
+        and their stored images are scheduled for deletion.
+        """
+        with transaction.atomic():
+            for asset_id, count in Counter(asset_ids).items():
+                self.filter(pk=asset_id).update(ref_count=models.F('ref_count') - count)
+
+            unused = self.select_for_update().filter(pk__in=asset_ids, ref_count__lte=0)
+            names = {image.name for image in unused.values_list('image', flat=True) if image}
+            unused.delete()
+            ImageDeletion.objects.schedule(names)
+
+
+class ImageAsset(models.Model):
+    """
+    Processed image in the image storage, shared by all images or avatars uploaded with the same content.
+    Its stored image is deleted once nothing refers to it.
+    """
+    POST_IMAGE = 'post_image'
+    AVATAR = 'avatar'
+    KIND_CHOICES = ((POST_IMAGE, 'Post image'), (AVATAR, 'Avatar'))
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    content_hash = models.CharField(max_length=64)  # sha256 of the upload as it was received
+    image = ImageStorageField('image', db_index=True)
+    width = models.PositiveIntegerField(blank=True, null=True)
+    height = models.PositiveIntegerField(blank=True, null=True)
+    ref_count = models.PositiveIntegerField(default=0)
+
+    objects = ImageAssetManager()
+
+    class Meta:
+        unique_together = ('kind', 'content_hash')
 
 
 class CustomUserManager(BaseUserManager):
@@ -64,53 +205,347 @@ class CustomUserManager(BaseUserManager):
         user.save(using=self._db)
         return user
 
+    def purge(self, user, chunk_size=500):
+        """
+        Deletes everything of the user scheduled for deletion in chunks of chunk_size rows,
+        each chunk in its own transaction, so no long lock is held and an interrupted purge resumes.
+        Counters of other users and posts are fixed along the way.
+        Yields (what, count) after every chunk, the user is deleted at the end.
+        """
+        steps = [
+            ('follows', Follow.objects.filter(user=user), self._release_follows),
+            ('followers', Follow.objects.filter(followed_id=user), self._release_followers),
+            ('follow suggestions', FollowSuggestion.objects.filter(user=user), None),
+            ('suggestions of the account', FollowSuggestion.objects.filter(suggested=user), None),
+            ('votes', Vote.objects.filter(user=user).exclude(post__user=user), self._release_votes),
+            ('votes on posts', Vote.objects.filter(post__user=user), None),
+            ('timeline entries', TimelineEntry.objects.filter(user=user), None),
+            ('timeline entries of posts', TimelineEntry.objects.filter(post__user=user), None),
+            ('posts', Post.objects.filter(user=user), None),
+        ]
+        for what, queryset, release in steps:
+            while True:
+                with transaction.atomic():
+                    # locked rows are skipped, so counters aren't fixed twice by concurrent workers
+                    ids = list(queryset.select_for_update(skip_locked=True, of=('self',)).order_by('pk')
+                               .values_list('pk', flat=True)[:chunk_size])
+                    if not ids:
+                        break
+                    if release:
+                        release(ids)
+                    # images of posts release their assets on delete
+                    queryset.model.objects.filter(pk__in=ids).delete()
+                yield what, len(ids)
+
+        cache.delete(TimelineEntry.objects.author_posts_cache_key(user.pk))
+        user.delete()
 
-class CustomUser(ImageThumbnailMixin, AbstractUser):
-    def avatar_public_id(self):
-        return '_'.join([str(self.pk), self.first_name, self.last_name])
+    @staticmethod
+    def _release_follows(follow_ids):
+        follows = list(Follow.objects.filter(pk__in=follow_ids).values_list('user_id', 'followed_id'))
+        Follow.objects.release_followed_counts([followed_id for _, followed_id in follows])
+        transaction.on_commit(lambda: CustomUserManager._log_unfollows(follows))
+
+    @staticmethod
+    def _release_followers(follow_ids):
+        follows = list(Follow.objects.filter(pk__in=follow_ids).values_list('user_id', 'followed_id'))
+        CustomUser.objects.filter(pk__in=[user_id for user_id, _ in follows]) \
+            .update(follow_count=models.F('follow_count') - 1)
+        transaction.on_commit(lambda: CustomUserManager._log_unfollows(follows))
+
+    @staticmethod
+    def _log_unfollows(follows):
+        for user_id, followed_id in follows:
+            follow_graph.log_delta(user_id, followed_id, followed=False)
 
+    @staticmethod
+    def _release_votes(vote_ids):
+        counters = {}
+        for post_id, vote in Vote.objects.filter(pk__in=vote_ids).values_list('post_id', 'vote'):
+            likes, dislikes = counters.get(post_id, (0, 0))
+            counters[post_id] = (likes - vote, dislikes - (not vote))
+        for post_id, (likes, dislikes) in counters.items():
+            Post(pk=post_id).update_vote_counters(likes=likes, dislikes=dislikes)
+
+
+class CustomUser(ImageThumbnailMixin, AbstractUser):
     def get_avatar_folder(self):
         if settings.DEBUG:
             return os.path.join('images', 'tests')
         else:
             return os.path.join('images', 'avatars')
 
+    def get_avatar_eager_transformations(self):
+        """Square crops are generated by the cloud once the avatar is updated"""
+        return [{'width': size, 'height': size, 'crop': 'fill', 'gravity': 'center'}
+                for size in CustomUser.avatar_sizes]
+
     username = None
     first_name = models.CharField(max_length=32)
     last_name = models.CharField(max_length=32)
     email = models.EmailField(verbose_name='email address', unique=True, max_length=255)
     bio = models.TextField(max_length=512)
-    avatar = CloudinaryField('image', folder=get_avatar_folder, use_filename=True,
-                             public_id=avatar_public_id)
+    avatar = ImageStorageField('image', folder=get_avatar_folder, use_filename=True,
+                               eager=get_avatar_eager_transformations, db_index=True)
+    avatar_asset = models.ForeignKey(ImageAsset, related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
     follow_count = models.IntegerField(default=0)
     followed_count = models.IntegerField(default=0)
+    deletion_requested_at = models.DateTimeField(blank=True, null=True, db_index=True)
 
     objects = CustomUserManager()
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
 
+    card_fields = {'avatar', 'first_name', 'last_name'}
+    avatar_sizes = (48, 150, 320)
+    acceptable_image_size = (avatar_sizes[-1], avatar_sizes[-1])
+    crop_thumbnail = True
+
     def save(self, *args, **kwargs):
+        released_asset_id = None
         if 'update_fields' in kwargs:
-            if 'avatar' in kwargs['update_fields']:
-                self.make_thumbnail(image_field=self.avatar)
+            if 'avatar' in kwargs['update_fields'] and isinstance(self.avatar, UploadedFile):
+                released_asset_id = self.avatar_asset_id
+                self.avatar_asset = ImageAsset.objects.acquire(ImageAsset.AVATAR, self.avatar, self._upload_avatar)
+                self.avatar = self.avatar_asset.image
+                kwargs['update_fields'] = [*kwargs['update_fields'], 'avatar_asset']
 
         super().save(*args, **kwargs)
 
+        if released_asset_id:
+            ImageAsset.objects.release([released_asset_id])
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or self.card_fields.intersection(update_fields):
+            self.posts.invalidate_cards()
+
+    def get_followed_count(self):
+        """Only accounts which aren't fanned out may have follower count shards"""
+        if TimelineEntry.objects.is_fanned_out(self):
+            return self.followed_count
+        shards = self.follower_count_shards.aggregate(count=models.Sum('count'))['count']
+        return self.followed_count + (shards or 0)
+
+    def request_deletion(self):
+        """The account is closed at once, its content is deleted later by the purge_accounts worker"""
+        self.is_active = False
+        self.deletion_requested_at = timezone.now()
+        self.save(update_fields=['is_active', 'deletion_requested_at'])
+
+    def _upload_avatar(self, file):
+        self.make_thumbnail(image_field=file)
+        return self._meta.get_field('avatar').upload(self, file)
+
+    def get_avatar_url(self, display_size):
+        """URL of the smallest square crop which is not smaller than display_size px"""
+        # a form which failed validation keeps the new upload, it isn't stored yet
+        if not isinstance(self.avatar, StoredImage):
+            return ''
+
+        size = next((size for size in self.avatar_sizes if size >= display_size), self.avatar_sizes[-1])
+        return self.avatar.build_url(width=size, height=size, crop='fill', gravity='center')
+
+
+class FollowManager(models.Manager):
+    def get_followed_ids(self, user, users):
+        """
+        Returns ids of the given users which the user follows, for a whole page
+        of users using one query.
+        """
+        user_ids = [listed_user.pk for listed_user in users]
+        if not user_ids or not user.is_authenticated:
+            return set()
+
+        return set(self.filter(user=user, followed_id__in=user_ids).values_list('followed_id', flat=True))
+
+    def follow(self, user, followed):
+        """
+        Inserts the follow and shifts counters of both users in one transaction.
+        Returns False if the user already follows the account.
+        """
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    self.create(user=user, followed_id=followed)
+            except IntegrityError:
+                return False
+            self._update_counters(user, followed, 1)
+            TimelineEntry.objects.backfill(user=user, author=followed)
+            # the rest of user's suggestions is refreshed by the worker from the delta log
+            FollowSuggestion.objects.filter(user=user, suggested=followed).delete()
+            transaction.on_commit(lambda: follow_graph.log_delta(user.pk, followed.pk, followed=True))
+        return True
+
+    def unfollow(self, user, followed):
+        """Returns False if the user doesn't follow the account."""
+        with transaction.atomic():
+            deleted, _ = self.filter(user=user, followed_id=followed).delete()
+            if not deleted:
+                return False
+            self._update_counters(user, followed, -1)
+            TimelineEntry.objects.prune(user=user, author=followed)
+            transaction.on_commit(lambda: follow_graph.log_delta(user.pk, followed.pk, followed=False))
+        return True
+
+    @staticmethod
+    def _update_counters(user, followed, delta):
+        CustomUser.objects.filter(pk=user.pk).update(follow_count=models.F('follow_count') + delta)
+        if settings.FOLLOWER_COUNT_SHARDS and not TimelineEntry.objects.is_fanned_out(followed):
+            FollowerCountShard.objects.add(followed, delta)
+        else:
+            CustomUser.objects.filter(pk=followed.pk).update(followed_count=models.F('followed_count') + delta)
+
+    @staticmethod
+    def release_followed_counts(followed_ids):
+        """
+        Takes one follower from each of the accounts, like _update_counters does for many unfollows.
+        Accounts which aren't fanned out lose the follower from a shard when shards are enabled.
+        """
+        sharded_ids = set()
+        if settings.FOLLOWER_COUNT_SHARDS:
+            sharded_ids = set(CustomUser.objects.filter(
+                pk__in=followed_ids, followed_count__gt=TimelineEntry.fan_out_followers_threshold
+            ).values_list('pk', flat=True))
+
+        for followed_id in sharded_ids:
+            FollowerCountShard.objects.add(CustomUser(pk=followed_id), -1)
+        CustomUser.objects.filter(pk__in=set(followed_ids) - sharded_ids) \
+            .update(followed_count=models.F('followed_count') - 1)
+
 
 class Follow(models.Model):
     user = models.ForeignKey(CustomUser, related_name='follower', on_delete=models.CASCADE)
     followed_id = models.ForeignKey(CustomUser, related_name='followed', on_delete=models.CASCADE)
 
+    objects = FollowManager()
+
     class Meta:
         unique_together = ('user', 'followed_id')
+        # follower and following lists are paginated by id, newest first
+        indexes = [models.Index(fields=['followed_id', '-id']), models.Index(fields=['user', '-id'])]
+
+
+class FollowSuggestionManager(models.Manager):
+    def refresh(self, graph, user_ids):
+        """
+        Replaces suggestions of the users with accounts which most of their followees follow,
+        ranked from the follow graph snapshot without querying follows.
+        """
+        candidates = {}
+        for user_id in user_ids:
+            counts = graph.get_followed_by_followed(user_id)
+            # spare candidates replace accounts which were closed after the snapshot
+            candidates[user_id] = heapq.nlargest(self.model.max_per_user * 2, counts.items(),
+                                                 key=lambda item: (item[1], -item[0]))
+
+        active_ids = set(CustomUser.objects.filter(
+            pk__in={*user_ids, *(pk for ranked in candidates.values() for pk, _ in ranked)},
+            is_active=True, deletion_requested_at__isnull=True).values_list('id', flat=True))
+        suggestions = []
+        for user_id, ranked in candidates.items():
+            if user_id in active_ids:
+                ranked = [(pk, score) for pk, score in ranked if pk in active_ids][:self.model.max_per_user]
+                suggestions.extend(self.model(user_id=user_id, suggested_id=pk, score=score) for pk, score in ranked)
+
+        with transaction.atomic():
+            self.filter(user_id__in=user_ids).delete()
+            self.bulk_create(suggestions)
+
+    def for_user(self, user):
+        """The panel of suggestions, one read of the (user, -score) index"""
+        return self.filter(user=user).select_related('suggested') \
+            .order_by('-score', 'suggested_id')[:self.model.max_per_user]
+
+
+class FollowSuggestion(models.Model):
+    """
+    Account the user may know, precomputed by the compute_suggestions worker.
+    Score is how many of the user's followees follow the account.
+    """
+    user = models.ForeignKey(CustomUser, related_name='follow_suggestions', on_delete=models.CASCADE)
+    suggested = models.ForeignKey(CustomUser, related_name='+', on_delete=models.CASCADE)
+    score = models.PositiveIntegerField()
+    max_per_user = 10
+
+    objects = FollowSuggestionManager()
+
+    class Meta:
+        unique_together = ('user', 'suggested')
+        indexes = [models.Index(fields=['user', '-score'])]
+
+
+class FollowerCountShardManager(models.Manager):
+    def add(self, user, delta):
+        """Shifts a random shard, so concurrent follows of the account rarely update the same row"""
+        shard = random.randrange(settings.FOLLOWER_COUNT_SHARDS)
+        if self.filter(user=user, shard=shard).update(count=models.F('count') + delta):
+            return
+
+        try:
+            with transaction.atomic():
+                self.create(user=user, shard=shard, count=delta)
+        except IntegrityError:
+            self.filter(user=user, shard=shard).update(count=models.F('count') + delta)
+
+
+class FollowerCountShard(models.Model):
+    """
+    Part of the follower count of an account with too many followers to fan out its posts.
+    The count is CustomUser.followed_count plus counts of all shards of the account.
+    """
+    user = models.ForeignKey(CustomUser, related_name='follower_count_shards', on_delete=models.CASCADE)
+    shard = models.PositiveSmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    objects = FollowerCountShardManager()
+
+    class Meta:
+        unique_together = ('user', 'shard')
+
+
+class PostQuerySet(models.QuerySet):
+    def for_cards(self):
+        """
+        Loads everything a post card renders (author with avatar, images and tags)
+        in a constant number of queries regardless of the page size.
+        Vote counts are denormalized into Post columns, so they need no annotation.
+        """
+        return self.select_related('user').prefetch_related('images', 'tags')
+
+    def invalidate_cards(self):
+        """Bumps version stamps, so cached post card fragments are rendered again"""
+        return self.update(card_version=models.F('card_version') + 1)
+
+
+# check constraints of Post can't refer to its class attributes
+MAX_TAGS_IN_POST = 5
+MAX_IMAGES_IN_POST = 10
+
+
+def shift_slot_count(field, delta):
+    """
+    Expression which shifts a slot counter of Post. Released slots never go below zero,
+    so a counter which lags behind its rows (see rebuild_slot_counters) can't break deletion.
+    """
+    if delta < 0:
+        return Greatest(models.F(field) + delta, 0)
+    return models.F(field) + delta
 
 
 class Post(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='posts')
     date = models.DateTimeField(auto_now_add=True)
     tags = models.ManyToManyField(to='Tag', related_name='posts', blank=True)
-    max_tags_count = 5
+    like_count = models.IntegerField(default=0)
+    dislike_count = models.IntegerField(default=0)
+    card_version = models.PositiveIntegerField(default=0)
+    image_count = models.PositiveSmallIntegerField(default=0)
+    tag_count = models.PositiveSmallIntegerField(default=0)
+    max_tags_count = MAX_TAGS_IN_POST
+    max_images_count = MAX_IMAGES_IN_POST
+
+    objects = PostQuerySet.as_manager()
 
     def get_likes(self):
         return self.votes.filter(vote=1).count()
@@ -118,22 +553,180 @@ class Post(models.Model):
     def get_dislikes(self):
         return self.votes.filter(vote=0).count()
 
+    def update_vote_counters(self, likes=0, dislikes=0):
+        """
+        Atomically shifts denormalized like/dislike counters by the given deltas.
+        Must be called in the same transaction as the vote insert, update or delete.
+        """
+        Post.objects.filter(pk=self.pk).update(like_count=models.F('like_count') + likes,
+                                               dislike_count=models.F('dislike_count') + dislikes,
+                                               card_version=models.F('card_version') + 1)
+
+    def reserve_slots(self, images=0, tags=0):
+        """
+        Atomically takes slots for new images and tags of the post, must be called in the same transaction
+        as their insert. Limits are check constraints, so concurrent requests can't exceed them.
+        Negative counts release slots. The post card is rendered again.
+        """
+        try:
+            with transaction.atomic():
+                Post.objects.filter(pk=self.pk).update(image_count=shift_slot_count('image_count', images),
+                                                       tag_count=shift_slot_count('tag_count', tags),
+                                                       card_version=models.F('card_version') + 1)
+        except IntegrityError:
+            if images > 0:
+                raise ValidationError(f'Post can\'t have more than {Post.max_images_count} images')
+            if tags > 0:
+                raise ValidationError(f'Post can\'t have more than {Post.max_tags_count} tags')
+            raise
+
     class Meta:
         ordering = ['-id']
+        constraints = [
+            models.CheckConstraint(check=models.Q(image_count__lte=MAX_IMAGES_IN_POST), name='post_image_count_limit'),
+            models.CheckConstraint(check=models.Q(tag_count__lte=MAX_TAGS_IN_POST), name='post_tag_count_limit'),
+        ]
 
     def save(self, *args, **kwargs):
         super(Post, self).save(*args, **kwargs)
 
 
+class VoteManager(models.Manager):
+    def get_votes_map(self, user, posts):
+        """
+        Returns {post_id: vote} of the given user for a whole page of posts
+        using one query. Posts without user's vote are not present in the map.
+        """
+        post_ids = [post.id for post in posts]
+        if not post_ids:
+            return {}
+
+        return dict(self.filter(user=user, post_id__in=post_ids).values_list('post_id', 'vote'))
+
+    def toggle(self, user, post, vote):
+        """
+        Likes (True) or dislikes (False) the post, the same vote again takes it back.
+        Returns (like_count, dislike_count, the user's vote or None) after the change.
+
+        Concurrent votes of the user are serialized by the lock of the vote row. When a concurrent
+        request inserts the vote first, the unique constraint fails in a savepoint and the vote
+        is updated instead, so double clicks don't raise IntegrityError.
+        """
+        with transaction.atomic():
+            user_vote = self.select_for_update().filter(user=user, post=post).first()
+            if user_vote is None:
+                try:
+                    with transaction.atomic():
+                        user_vote = self.create(user=user, post=post, vote=vote)
+                except IntegrityError:
+                    user_vote = self.select_for_update().get(user=user, post=post)
+                else:
+                    self._update_vote_counters(post, vote, 1)
+                    return self._get_counts(post) + (vote,)
+
+            if user_vote.vote == vote:
+                user_vote.delete()
+                self._update_vote_counters(post, vote, -1)
+                return self._get_counts(post) + (None,)
+
+            user_vote.vote = vote
+            user_vote.save(update_fields=['vote'])
+            self._update_vote_counters(post, vote, 1)
+            self._update_vote_counters(post, not vote, -1)
+            return self._get_counts(post) + (vote,)
+
+    @staticmethod
+    def _update_vote_counters(post, vote, delta):
+        if vote:
+            post.update_vote_counters(likes=delta)
+        else:
+            post.update_vote_counters(dislikes=delta)
+
+    @staticmethod
+    def _get_counts(post):
+        return tuple(Post.objects.filter(pk=post.pk).values_list('like_count', 'dislike_count').get())
+
+
 class Vote(models.Model):
     user = models.ForeignKey(CustomUser, related_name='votes', on_delete=models.CASCADE)
     post = models.ForeignKey(Post, related_name='votes', on_delete=models.CASCADE)
     vote = models.BooleanField()
 
+    objects = VoteManager()
+
     class Meta:
         unique_together = ('user', 'post')
 
 
+class ImagesManager(models.Manager):
+    upload_max_workers = 4
+
+    def process(self, images):
+        """
+        Thumbnails and uploads images of a post concurrently, then marks them ready in one query.
+        Content which was uploaded before, by anyone, is reused instead of being uploaded again.
+        If any upload fails, images that are already in the cloud are destroyed and the error is re-raised,
+        so the rows stay untouched.
+        """
+        content_hashes = {}
+        for image in images:
+            with image.raw_image.open('rb') as raw_image:
+                content_hashes[image.pk] = get_content_hash(raw_image)
+        assets = {asset.content_hash: asset for asset in ImageAsset.objects.filter(
+            kind=ImageAsset.POST_IMAGE, content_hash__in=content_hashes.values())}
+        uploads = {}  # images with the same content are uploaded once
+        for image in images:
+            if content_hashes[image.pk] not in assets:
+                uploads.setdefault(content_hashes[image.pk], image)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.upload_max_workers, len(uploads)))) as executor:
+            futures = [executor.submit(image.upload) for image in uploads.values()]
+            wait(futures)
+
+        raw_images = [image.raw_image.name for image in images]
+        try:
+            for future in futures:
+                future.result()
+
+            with transaction.atomic():
+                for content_hash, image in uploads.items():
+                    assets[content_hash] = ImageAsset.objects.register(ImageAsset.POST_IMAGE, content_hash,
+                                                                       image.image)
+                references = Counter(assets[content_hash].pk for content_hash in content_hashes.values())
+                ImageAsset.objects.add_references(references)
+
+                for image in images:
+                    asset = assets[content_hashes[image.pk]]
+                    image.asset, image.image, image.width, image.height = asset, asset.image, asset.width, asset.height
+                    image.status = self.model.READY
+                    image.raw_image = ''
+                self.bulk_update(images, ['asset', 'image', 'width', 'height', 'status', 'raw_image'])
+        except Exception:
+            self.destroy_uploaded(uploads.values())
+            raise
+
+        self._delete_raw_images(raw_images)
+        Post.objects.filter(pk__in={image.post_id for image in images}).invalidate_cards()
+
+    def fail(self, images):
+        """Marks images which can't be processed failed, their raw uploads are of no use anymore"""
+        raw_images = [image.raw_image.name for image in images if image.raw_image]
+        self.filter(pk__in=[image.pk for image in images]).update(status=self.model.FAILED, raw_image='')
+        transaction.on_commit(lambda: self._delete_raw_images(raw_images))
+        Post.objects.filter(pk__in={image.post_id for image in images}).invalidate_cards()
+
+    def _delete_raw_images(self, names):
+        storage = self.model._meta.get_field('raw_image').storage
+        for name in names:
+            storage.delete(name)
+
+    @staticmethod
+    def destroy_uploaded(images):
+        ImageDeletion.objects.schedule({image.image.name for image in images if isinstance(image.image, StoredImage)})
+        for image in images:
+            image.image = None
+
+
 class Images(ImageThumbnailMixin, models.Model):
     def get_image_folder(self):
         if settings.DEBUG:
@@ -141,48 +734,392 @@ class Images(ImageThumbnailMixin, models.Model):
         else:
             return os.path.join('images', 'posts')
 
+    def get_eager_transformations(self):
+        """Renditions are generated by the cloud once at upload instead of on the first request"""
+        return [{'width': width, 'crop': 'limit', 'format': image_format}
+                for width in Images.rendition_widths for image_format in Images.rendition_formats]
+
+    PROCESSING = 'processing'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PROCESSING, 'Processing'), (READY, 'Ready'), (FAILED, 'Failed'))
+
     post = models.ForeignKey(Post, related_name='images', on_delete=models.CASCADE)
-    image = CloudinaryField('image', folder=get_image_folder, use_filename=True)
-    max_count_images_in_post = 10
+    image = ImageStorageField('image', folder=get_image_folder, use_filename=True, eager=get_eager_transformations,
+                              width_field='width', height_field='height', blank=True, null=True, db_index=True)
+    width = models.PositiveIntegerField(blank=True, null=True)
+    height = models.PositiveIntegerField(blank=True, null=True)
+    asset = models.ForeignKey(ImageAsset, related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+    raw_image = models.FileField(upload_to='raw_images/', storage=RawImageStorage(), blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=READY, db_index=True)
+    max_count_images_in_post = Post.max_images_count
+    rendition_widths = (320, 640, 1280)
+    rendition_formats = ('webp', 'jpg')
+
+    objects = ImagesManager()
 
     class Meta:
         verbose_name = 'image'
         verbose_name_plural = 'images'
 
-    def validate_count_images_in_post(self):
-        images_count = self.post.images.all().count()
-        if images_count >= Images.max_count_images_in_post:
-            raise ValidationError(f'Post can\'t have more than {Images.max_count_images_in_post} images')
+    @property
+    def is_ready(self):
+        return self.status == Images.READY
+
+    @property
+    def renditions(self):
+        """
+        [(rendition_width, width, height)] of the renditions generated at upload.
+        Renditions are never upscaled, so the widest one may be narrower than its rendition width.
+        """
+        if not self.width:
+            return []
+
+        renditions = []
+        for rendition_width in Images.rendition_widths:
+            width = min(rendition_width, self.width)
+            renditions.append((rendition_width, width, round(self.height * width / self.width)))
+            if width == self.width:
+                break
+        return renditions
+
+    def get_rendition_url(self, rendition_width, image_format):
+        return self.image.build_url(width=rendition_width, crop='limit', format=image_format)
 
     def save(self, *args, **kwargs):
-        self.validate_count_images_in_post()
-        self.make_thumbnail(self.image)
+        if self._state.adding:
+            self.post.reserve_slots(images=1)
+        if isinstance(self.image, UploadedFile):
+            self.asset = ImageAsset.objects.acquire(ImageAsset.POST_IMAGE, self.image, self._upload_image)
+            self.image, self.width, self.height = self.asset.image, self.asset.width, self.asset.height
         super(Images, self).save(*args, **kwargs)
 
+    def upload(self):
+        """Thumbnails the raw upload and uploads it to the cloud without touching the database."""
+        with self.raw_image.open('rb') as raw_image:
+            self.image = self._upload_image(UploadedFile(file=raw_image, name=os.path.basename(raw_image.name)))
+
+    def _upload_image(self, file):
+        self.make_thumbnail(file)
+        return self._meta.get_field('image').upload(self, file)
+
+    def process(self):
+        """
+        Thumbnails the raw upload, uploads it to the cloud and marks the image ready.
+        Called by the background worker, see process_images command.
+        """
+        Images.objects.process([self])
+
+
+class TagManager(models.Manager):
+    id_cache_size = 1024
+
+    def __init__(self):
+        super().__init__()
+        # LRU of hot tag names, {name: id}, local to the process. lru_cache would memoize lookups
+        # of one name, ids are cached only on commit, after a batch lookup, so threads share a lock.
+        self._id_cache = OrderedDict()
+        self._id_cache_lock = threading.Lock()
+
+    def get_ids(self, names):
+        """Returns {name: id}, missing tags are created with one insert and looked up with one query."""
+        ids = {}
+        with self._id_cache_lock:
+            for name in names:
+                if name in self._id_cache:
+                    self._id_cache.move_to_end(name)
+                    ids[name] = self._id_cache[name]
+
+        missing = [name for name in names if name not in ids]
+        if missing:
+            self.bulk_create([self.model(name=name) for name in missing], ignore_conflicts=True)
+            found = dict(self.filter(name__in=missing).values_list('name', 'id'))
+            ids.update(found)
+            # ids of tags created in a rolled back transaction must not be cached
+            transaction.on_commit(lambda: self._cache_ids(found))
+
+        return {name: ids[name] for name in names}
+
+    def _cache_ids(self, ids):
+        with self._id_cache_lock:
+            self._id_cache.update(ids)
+            while len(self._id_cache) > self.id_cache_size:
+                self._id_cache.popitem(last=False)
+
+    def clear_id_cache(self):
+        """Tags are deleted only by admins, the cache of other processes may keep their ids until restart"""
+        with self._id_cache_lock:
+            self._id_cache.clear()
+
+    def add_to_post(self, post, names):
+        """
+        Adds tags to the post with one count check and one insert of through rows.
+        Tags which don't fit into Post.max_tags_count aren't added, their names are returned.
+        """
+        names = list(dict.fromkeys(name.lower() for name in names))
+        ids = self.get_ids(names)
+        through = Post.tags.through
+        existing = set(through.objects.filter(post=post).values_list('tag_id', flat=True))
+        new = {name: tag_id for name, tag_id in ids.items() if tag_id not in existing}
+        free_slots = max(Post.max_tags_count - len(existing), 0)
+        added = list(new.items())[:free_slots]
+
+        if added:
+            with transaction.atomic():
+                post.reserve_slots(tags=len(added))
+                through.objects.bulk_create([through(post_id=post.pk, tag_id=tag_id) for _, tag_id in added])
+        return list(new)[free_slots:]
+
 
 class Tag(models.Model):
     name = models.CharField(max_length=16, unique=True)
 
+    objects = TagManager()
+
     def save(self, *args, **kwargs):
         self.name = self.name.lower()
         super(Tag, self).save(*args, **kwargs)
 
 
+class TimelineEntryManager(models.Manager):
+    fan_out_batch_size = 1000
+    author_posts_cache_timeout = 60 * 60
+    # other workers can't invalidate a cache which is private to the process, so it's trusted only briefly
+    author_posts_local_cache_timeout = 5
+
+    def is_fanned_out(self, author):
+        """Posts of authors with too many followers are merged into timelines on read instead."""
+        return author.followed_count <= self.model.fan_out_followers_threshold
+
+    def fan_out(self, post):
+        """
+        Pushes a new post to the timelines of the author and all author's followers.
+        Every batch of timelines is trimmed right away, so they stay capped at max_entries_per_user.
+        """
+        entries = [self.model(user_id=post.user_id, post=post)]
+
+        if not self.is_fanned_out(post.user):
+            self._add_entries(entries)
+            cache.delete(self.author_posts_cache_key(post.user_id))
+            return
+
+        follower_ids = Follow.objects.filter(followed_id=post.user_id).values_list('user_id', flat=True)
+        for follower_id in follower_ids.iterator(chunk_size=self.fan_out_batch_size):
+            entries.append(self.model(user_id=follower_id, post=post))
+            if len(entries) >= self.fan_out_batch_size:
+                self._add_entries(entries)
+                entries = []
+
+        self._add_entries(entries)
+
+    def _add_entries(self, entries):
+        self.bulk_create(entries, ignore_conflicts=True)
+        self.trim_many([entry.user_id for entry in entries])
+
+    def backfill(self, user, author):
+        """Adds recent posts of the followed author to the user's timeline."""
+        if not self.is_fanned_out(author):
+            return
+
+        post_ids = Post.objects.filter(user=author).order_by('-id') \
+            .values_list('id', flat=True)[:self.model.max_entries_per_user]
+        self.bulk_create([self.model(user=user, post_id=post_id) for post_id in post_ids], ignore_conflicts=True)
+        self.trim(user)
+
+    def prune(self, user, author):
+        """Removes posts of the unfollowed author from the user's timeline."""
+        self.filter(user=user, post__user=author).delete()
+
+    def trim(self, user):
+        """Keeps only max_entries_per_user most recent entries in the user's timeline."""
+        max_entries = self.model.max_entries_per_user
+        oldest_kept = list(self.filter(user=user).order_by('-post_id')
+                           .values_list('post_id', flat=True)[max_entries - 1:max_entries])
+        if oldest_kept:
+            self.filter(user=user, post_id__lt=oldest_kept[0]).delete()
+
+    def trim_many(self, user_ids):
+        """trim() of many timelines in two queries, the oldest kept entry of each user is found by the index"""
+        if not user_ids:
+            return
+
+        max_entries = self.model.max_entries_per_user
+        oldest_kept = CustomUser.objects.filter(pk__in=user_ids).annotate(oldest_kept_id=models.Subquery(
+            self.filter(user=models.OuterRef('pk')).order_by('-post_id')
+            .values('post_id')[max_entries - 1:max_entries]
+        )).filter(oldest_kept_id__isnull=False).values_list('pk', 'oldest_kept_id')
+
+        overflowed = models.Q()
+        for user_id, post_id in oldest_kept:
+            overflowed |= models.Q(user_id=user_id, post_id__lt=post_id)
+        if overflowed:
+            self.filter(overflowed).delete()
+
+    @staticmethod
+    def author_posts_cache_key(author_id):
+        return f'timeline:author_posts:{author_id}'
+
+    def get_author_post_ids(self, author_ids):
+        """Returns {author_id: [post_id, ...]} of recent posts, newest first, cached per author."""
+        keys = {self.author_posts_cache_key(author_id): author_id for author_id in author_ids}
+        cached = cache.get_many(keys.keys())
+        post_ids = {keys[key]: value for key, value in cached.items()}
+
+        missed = {}
+        for key, author_id in keys.items():
+            if author_id not in post_ids:
+                post_ids[author_id] = missed[key] = list(
+                    Post.objects.filter(user_id=author_id).order_by('-id')
+                    .values_list('id', flat=True)[:self.model.max_entries_per_user])
+
+        cache.set_many(missed, timeout=self.get_author_posts_cache_timeout())
+        return post_ids
+
+    def get_author_posts_cache_timeout(self):
+        if isinstance(caches[DEFAULT_CACHE_ALIAS], LocMemCache):
+            return self.author_posts_local_cache_timeout
+        return self.author_posts_cache_timeout
+
+    def get_page_post_ids(self, user, limit, before=None, after=None):
+        """
+        Returns ids of at most `limit` timeline posts older than `before` (newest first)
+        or newer than `after` (oldest first). The precomputed timeline is merged
+        with recent posts of followed authors which are not fanned out.
+        """
+        entries = self.filter(user=user)
+        celebrity_ids = Follow.objects.filter(
+            user=user, followed_id__followed_count__gt=self.model.fan_out_followers_threshold
+        ).values_list('followed_id', flat=True)
+        sources = list(self.get_author_post_ids(celebrity_ids).values())
+
+        if after is None:
+            if before is not None:
+                entries = entries.filter(post_id__lt=before)
+                sources = [[pk for pk in post_ids if pk < before] for post_ids in sources]
+            entries = entries.order_by('-post_id')
+        else:
+            entries = entries.filter(post_id__gt=after).order_by('post_id')
+            sources = [[pk for pk in reversed(post_ids) if pk > after] for post_ids in sources]
+
+        if not any(sources):
+            return list(entries.values_list('post_id', flat=True)[:limit])
+
+        sources.append(entries.values_list('post_id', flat=True)[:limit])
+        merged = heapq.merge(*sources, reverse=after is None)
+
+        page, last_id = [], None
+        while len(page) < limit:
+            candidates = []
+            for post_id in merged:
+                if post_id != last_id:  # skip posts both fanned out and merged on read
+                    candidates.append(post_id)
+                    last_id = post_id
+                if len(page) + len(candidates) == limit:
+                    break
+            if not candidates:
+                break
+
+            # cached ids of deleted posts are dropped, the page is filled up with the following ones
+            existing_ids = set(Post.objects.filter(id__in=candidates).values_list('id', flat=True))
+            page.extend(post_id for post_id in candidates if post_id in existing_ids)
+        return page
+
+
+class TimelineEntry(models.Model):
+    """
+    Precomputed home timeline. Every user has a row for each post of followed authors,
+    so reading a timeline page is one range scan over the (user, post) index.
+    Posts of authors with more than fan_out_followers_threshold followers are not
+    fanned out, they are merged into the timeline on read.
+    """
+    user = models.ForeignKey(CustomUser, related_name='timeline', on_delete=models.CASCADE)
+    post = models.ForeignKey(Post, related_name='timeline_entries', on_delete=models.CASCADE)
+    max_entries_per_user = 800
+    fan_out_followers_threshold = settings.TIMELINE_FAN_OUT_THRESHOLD
+
+    objects = TimelineEntryManager()
+
+    class Meta:
+        unique_together = ('user', 'post')
+        verbose_name_plural = 'timeline entries'
+
+
 @receiver(m2m_changed, sender=Post.tags.through)
-def validate_count_tags_in_post(sender, action, **kwargs):
-    if action == 'pre_add':
-        instance = kwargs['instance']
-        pk = list(kwargs['pk_set'])[0]
+def update_tag_count(sender, instance, action, pk_set, **kwargs):
+    """Tags added or removed through the related managers keep Post.tag_count in sync"""
+    if isinstance(instance, Post):
+        if action == 'pre_add' and pk_set:
+            instance.reserve_slots(tags=len(pk_set))
+        elif action == 'post_remove' and pk_set:
+            instance.reserve_slots(tags=-len(pk_set))
+        elif action == 'post_clear':
+            Post.objects.filter(pk=instance.pk).update(tag_count=0)
+    else:
+        if action == 'pre_add' and pk_set:
+            try:
+                with transaction.atomic():
+                    Post.objects.filter(pk__in=pk_set).update(tag_count=models.F('tag_count') + 1)
+            except IntegrityError:
+                raise ValidationError(f'Post can\'t have more than {Post.max_tags_count} tags')
+        elif action == 'post_remove' and pk_set:
+            Post.objects.filter(pk__in=pk_set).update(tag_count=shift_slot_count('tag_count', -1))
+        elif action == 'pre_clear':
+            instance.posts.update(tag_count=shift_slot_count('tag_count', -1))
 
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def invalidate_post_cards_on_tags_change(sender, instance, action, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
         if isinstance(instance, Post):
-            tags_count = instance.tags.all().count()
-        elif isinstance(instance, Tag):
-            tags_count = Post.objects.get(id=pk).tags.all().count()
+            Post.objects.filter(pk=instance.pk).invalidate_cards()
+        elif pk_set:
+            Post.objects.filter(pk__in=pk_set).invalidate_cards()
+    elif action == 'pre_clear' and isinstance(instance, Tag):
+        instance.posts.invalidate_cards()
+
+
+@receiver(pre_delete, sender=Tag)
+def release_post_tag_slots(sender, instance, **kwargs):
+    # through rows of the tag are deleted without m2m_changed
+    instance.posts.update(tag_count=shift_slot_count('tag_count', -1))
+
+
+@receiver(post_delete, sender=Tag)
+def forget_tag_id(sender, instance, **kwargs):
+    Tag.objects.clear_id_cache()
+
 
-        if tags_count >= Post.max_tags_count:
-            raise ValidationError(f'Post can\'t have more than {Post.max_tags_count} tags')
+@receiver(post_delete, sender=Post)
+def forget_author_post_id(sender, instance, **kwargs):
+    key = TimelineEntry.objects.author_posts_cache_key(instance.user_id)
+    # a read in between would cache the deleted post again
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+@receiver(post_save, sender=Images)
+def invalidate_post_card_on_images_change(sender, instance, **kwargs):
+    Post.objects.filter(pk=instance.post_id).invalidate_cards()
+
+
+@receiver(post_delete, sender=Images)
+def release_post_image_slot(sender, instance, **kwargs):
+    Post.objects.filter(pk=instance.post_id).update(image_count=shift_slot_count('image_count', -1),
+                                                    card_version=models.F('card_version') + 1)
 
 
 @receiver(pre_delete, sender=Images)
-def delete_image_in_cloud(sender, instance, **kwargs):
-    cloudinary.uploader.destroy(instance.image.public_id, invalidate=True)
+def release_image_asset(sender, instance, **kwargs):
+    if instance.asset_id:
+        ImageAsset.objects.release([instance.asset_id])
+    elif instance.image:
+        # images uploaded before assets were introduced aren't shared
+        ImageDeletion.objects.schedule([instance.image.name])
+    if instance.raw_image:
+        instance.raw_image.delete(save=False)
+
+
+@receiver(pre_delete, sender=CustomUser)
+def release_avatar_asset(sender, instance, **kwargs):
+    if instance.avatar_asset_id:
+        ImageAsset.objects.release([instance.avatar_asset_id])
@@ -0,0 +1,87 @@
+from hashlib import md5
+
+from django.core.cache import cache
+from django.http import HttpResponse
+
+
+def get_page_cache_key(path):
+    return 'anonymous_page:' + md5(path.encode()).hexdigest()
+
+
+def _get_fresh_key(page_key):
+    return page_key + ':fresh'
+
+
+def _get_lock_key(page_key):
+    return page_key + ':lock'
+
+
+def _get_post_key(post_id):
+    return f'anonymous_page:post:{post_id}'
+
+
+def invalidate_page(path):
+    """Marks the cached page stale, it's served until one worker renders a fresh copy"""
+    cache.delete(_get_fresh_key(get_page_cache_key(path)))
+
+
+def invalidate_post_pages(post_id):
+    """Marks stale the page which the post was last cached on"""
+    page_key = cache.get(_get_post_key(post_id))
+    if page_key:
+        cache.delete(_get_fresh_key(page_key))
+
+
+class AnonymousPageCacheMixin:
+    """
+    Caches whole responses for anonymous users. Page is fresh for page_cache_timeout
+    seconds, then it's served stale for up to page_cache_stale_timeout seconds while
+    the only worker which holds the lock renders a fresh copy.
+    Workers see each other's locks and invalidations through the shared cache, see CACHES in settings.
+    """
+    page_cache_timeout = 10
+    page_cache_stale_timeout = 300
+    page_cache_lock_timeout = 30
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method != 'GET' or request.user.is_authenticated:
+            return super().dispatch(request, *args, **kwargs)
+
+        page_key = get_page_cache_key(request.get_full_path())
+        fresh_key, lock_key = _get_fresh_key(page_key), _get_lock_key(page_key)
+        cached = cache.get_many([page_key, fresh_key])
+        page = cached.get(page_key)
+
+        if page is not None and fresh_key in cached:
+            return self._build_cached_response(page)
+
+        if not cache.add(lock_key, True, self.page_cache_lock_timeout):
+            if page is not None:
+                return self._build_cached_response(page)
+            # nothing to serve while other worker renders the page for the first time
+            return super().dispatch(request, *args, **kwargs)
+
+        try:
+            response = super().dispatch(request, *args, **kwargs)
+            self._store_response(response, page_key)
+        finally:
+            cache.delete(lock_key)
+
+        return response
+
+    @staticmethod
+    def _build_cached_response(page):
+        return HttpResponse(page['content'], content_type=page['content_type'])
+
+    def _store_response(self, response, page_key):
+        if hasattr(response, 'render'):
+            response.render()
+        if response.status_code != 200 or response.cookies:
+            return
+
+        page = {'content': response.content, 'content_type': response['Content-Type']}
+        context = getattr(response, 'context_data', None) or {}
+        post_keys = {_get_post_key(post.pk): page_key for post in context.get('posts', ())}
+
+        cache.set_many({page_key: page, **post_keys}, self.page_cache_timeout + self.page_cache_stale_timeout)
+        cache.set(_get_fresh_key(page_key), True, self.page_cache_timeout)
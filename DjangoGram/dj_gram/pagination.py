@@ -0,0 +1,94 @@
+from django.http import Http404
+from django.utils.encoding import force_bytes, force_str
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+
+
+class CursorPage:
+    """
+    Page of a keyset pagination. Cursors are opaque strings which point
+    to the edge of the page, so no COUNT(*) or OFFSET is needed to build it.
+    """
+    next_direction = 'n'
+    previous_direction = 'p'
+
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @staticmethod
+    def encode_cursor(direction, pk):
+        return urlsafe_base64_encode(force_bytes(f'{direction}:{pk}'))
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            direction, pk = force_str(urlsafe_base64_decode(cursor)).split(':')
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise Http404('Invalid cursor')
+
+        if direction not in (CursorPage.next_direction, CursorPage.previous_direction) or pk < 0:
+            raise Http404('Invalid cursor')
+        return direction, pk
+
+    @property
+    def next_cursor(self):
+        if self.object_list:
+            return self.encode_cursor(self.next_direction, self.object_list[-1].pk)
+
+    @property
+    def previous_cursor(self):
+        if self.object_list:
+            return self.encode_cursor(self.previous_direction, self.object_list[0].pk)
+
+    @property
+    def last_cursor(self):
+        """Points before the oldest object, so the page of the oldest objects is loaded"""
+        return self.encode_cursor(self.previous_direction, 0)
+
+
+class CursorPaginationMixin:
+    """
+    Replaces offset pagination of ListView with keyset pagination over
+    primary keys in descending order. Cost of any page equals cost of the first one.
+    """
+    cursor_kwarg = 'cursor'
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        queryset = queryset.order_by('-pk')
+
+        if not cursor:
+            object_list = list(queryset[:page_size + 1])
+            has_next, has_previous = len(object_list) > page_size, False
+            object_list = object_list[:page_size]
+        else:
+            direction, pk = CursorPage.decode_cursor(cursor)
+
+            if direction == CursorPage.next_direction:
+                object_list = list(queryset.filter(pk__lt=pk)[:page_size + 1])
+                has_next, has_previous = len(object_list) > page_size, True
+                object_list = object_list[:page_size]
+            else:
+                object_list = list(queryset.filter(pk__gt=pk).reverse()[:page_size + 1])
+                has_next, has_previous = pk > 0, len(object_list) > page_size
+                object_list = object_list[:page_size][::-1]
+
+        page = CursorPage(object_list, has_next=has_next, has_previous=has_previous)
+        return None, page, page.object_list, page.has_other_pages()
@@ -0,0 +1,35 @@
+// Votes of the post footer are sent in the background and the post card is updated in place,
+// without JavaScript the vote form is submitted as is.
+document.addEventListener('click', function (event) {
+  const button = event.target.closest('.post-footer-buttons button[formaction]');
+  const token = button && button.form && button.form.querySelector('[name="csrfmiddlewaretoken"]');
+  if (!token) {
+    return;
+  }
+  event.preventDefault();
+
+  fetch(button.formAction, {
+    method: 'POST',
+    headers: {'Accept': 'application/json', 'X-CSRFToken': token.value},
+    credentials: 'same-origin',
+  })
+    .then(function (response) {
+      if (!response.ok || response.redirected) {
+        throw new Error(response.statusText);
+      }
+      return response.json();
+    })
+    .then(function (data) {
+      const post = button.closest('.post');
+      post.querySelector('.like-count').textContent = data.like_count;
+      post.querySelector('.dislike-count').textContent = data.dislike_count;
+      post.classList.remove('post-voted-like', 'post-voted-dislike');
+      if (data.vote !== null) {
+        post.classList.add(data.vote ? 'post-voted-like' : 'post-voted-dislike');
+      }
+    })
+    .catch(function () {
+      // the vote may have been applied, so it's never sent again, the page shows the actual state
+      window.location.reload();
+    });
+});
@@ -5,3 +5,11 @@ register = template.Library()
 @register.filter()
 def get_vote(votes, post_id):
     return votes[post_id]
+
+
+@register.filter()
+def get_vote_class(votes, post_id):
+    """Class of the post wrapper which highlights the viewer's vote on the cached post card"""
+    if not votes or post_id not in votes:
+        return ''
+    return 'post-voted-like' if votes[post_id] else 'post-voted-dislike'
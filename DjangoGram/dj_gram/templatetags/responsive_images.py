@@ -0,0 +1,13 @@
+from django import template
+register = template.Library()
+
+
+@register.filter()
+def srcset(image, image_format):
+    return ', '.join(f'{image.get_rendition_url(rendition_width, image_format)} {width}w'
+                     for rendition_width, width, _ in image.renditions)
+
+
+@register.filter()
+def avatar_url(user, display_size):
+    return user.get_avatar_url(display_size)
@@ -1,7 +1,6 @@
 from io import BytesIO
 
 from PIL import Image
-import cloudinary
 from django.core.files.uploadedfile import InMemoryUploadedFile
 
 
@@ -15,15 +14,3 @@ def create_test_image(size=(100, 100)):
                                       content_type='image/jpeg',
                                       size=image.size, charset=None)
     return temp_image
-
-
-def delete_cloudinary_images(users=None, images=None):
-    if users:
-        for user in users:
-            if user.avatar.public_id:
-                cloudinary.uploader.destroy(user.avatar.public_id, invalidate=True)
-
-    if images:
-        for image in images:
-            if image.image.public_id:
-                cloudinary.uploader.destroy(image.image.public_id, invalidate=True)
@@ -0,0 +1,25 @@
+import os
+import shutil
+import tempfile
+
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+
+class LocalImageStorageTestRunner(DiscoverRunner):
+    """Tests keep images in a temporary local image storage instead of making round-trips to Cloudinary"""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.image_storage_root = tempfile.mkdtemp()
+        self.image_storage_settings = override_settings(
+            IMAGE_STORAGE_BACKEND='dj_gram.image_storage.LocalImageStorage',
+            IMAGE_STORAGE_ROOT=self.image_storage_root,
+            RAW_IMAGE_ROOT=os.path.join(self.image_storage_root, 'raw'),
+        )
+        self.image_storage_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.image_storage_settings.disable()
+        shutil.rmtree(self.image_storage_root, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
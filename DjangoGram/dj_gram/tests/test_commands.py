@@ -0,0 +1,335 @@
+import tempfile
+import time
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from dj_gram.image_storage import LocalImageStorage, get_image_storage
+from dj_gram.models import *
+from .conf import create_test_image
+
+
+class TestRebuildVoteCounters(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = [CustomUser.objects.create_user(email=f'user{i}@foo.foo') for i in range(3)]
+        for _ in range(5):
+            post = Post.objects.create(user=users[0])
+            Vote.objects.create(user=users[0], post=post, vote=True)
+            Vote.objects.create(user=users[1], post=post, vote=True)
+            Vote.objects.create(user=users[2], post=post, vote=False)
+
+        Post.objects.create(user=users[0], like_count=7, dislike_count=3)  # drifted post without votes
+
+    def test_rebuild(self):
+        out = StringIO()
+        call_command('rebuild_vote_counters', chunk_size=2, stdout=out)
+
+        for post in Post.objects.all():
+            with self.subTest(post=post.id):
+                self.assertEqual((post.like_count, post.dislike_count), (post.get_likes(), post.get_dislikes()))
+
+        self.assertIn('Checked 6 posts, fixed 6 counters.', out.getvalue())
+
+    def test_rebuild_skips_consistent_posts(self):
+        call_command('rebuild_vote_counters', stdout=StringIO())
+
+        out = StringIO()
+        call_command('rebuild_vote_counters', stdout=out)
+        self.assertIn('fixed 0 counters.', out.getvalue())
+
+
+class TestRebuildSlotCounters(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user(email='foo@foo.foo')
+        tags = [Tag.objects.create(name=f'tag{i}') for i in range(2)]
+        for _ in range(3):
+            post = Post.objects.create(user=user)
+            post.tags.add(*tags)
+            Images.objects.create(post=post, image='sample')
+        Post.objects.update(image_count=0, tag_count=0)  # posts created before the counters
+
+    def test_rebuild(self):
+        out = StringIO()
+        call_command('rebuild_slot_counters', chunk_size=2, stdout=out)
+
+        self.assertEqual(set(Post.objects.values_list('image_count', 'tag_count')), {(1, 2)})
+        self.assertIn('Checked 3 posts, fixed 3 counters.', out.getvalue())
+
+    def test_post_over_the_limit_is_full(self):
+        post = Post.objects.first()
+        Images.objects.bulk_create([Images(post=post, image='sample') for _ in range(Post.max_images_count)])
+        call_command('rebuild_slot_counters', stdout=StringIO())
+
+        post.refresh_from_db()
+        self.assertEqual(post.image_count, Post.max_images_count)
+
+
+class TestTrimTimelines(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user(email='foo@foo.foo')
+        author = CustomUser.objects.create_user(email='bar@bar.bar')
+        Follow.objects.create(user=user, followed_id=author)
+        for _ in range(4):
+            Post.objects.create(user=author)
+
+    def setUp(self):
+        self.user = CustomUser.objects.get(email='foo@foo.foo')
+        self.author = CustomUser.objects.get(email='bar@bar.bar')
+
+    def test_backfill(self):
+        call_command('trim_timelines', backfill=True, stdout=StringIO())
+
+        self.assertEqual(self.user.timeline.count(), 4)
+        self.assertEqual(self.author.timeline.count(), 4)
+
+    def test_trim(self):
+        for post in Post.objects.all():
+            TimelineEntry.objects.create(user=self.user, post=post)
+
+        out = StringIO()
+        with patch.object(TimelineEntry, 'max_entries_per_user', 3):
+            call_command('trim_timelines', stdout=out)
+
+        newest_ids = list(Post.objects.values_list('id', flat=True)[:3])
+        self.assertEqual(sorted(self.user.timeline.values_list('post_id', flat=True), reverse=True), newest_ids)
+        self.assertIn('Trimmed 1 timelines.', out.getvalue())
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TestProcessImages(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(email='foo@foo.foo')
+        self.posts = [Post.objects.create(user=user) for _ in range(2)]
+        for post, images_count in zip(self.posts, (3, 2)):
+            for _ in range(images_count):
+                Images.objects.create(post=post, raw_image=create_test_image(), status=Images.PROCESSING)
+
+    def test_process(self):
+        out = StringIO()
+        call_command('process_images', batch_size=1, stdout=out)
+
+        self.assertEqual(list(self.posts[0].images.values_list('status', flat=True)), [Images.READY] * 3)
+        self.assertFalse(self.posts[1].images.filter(status=Images.READY).exists())
+        self.assertIn('Processed 3 images.', out.getvalue())
+
+    @patch.object(LocalImageStorage, 'save', side_effect=Exception('Storage is unavailable'))
+    def test_failed(self, save):
+        raw_images = [image.raw_image.name for image in Images.objects.all()]
+        with self.assertLogs('dj_gram.management.commands.process_images', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('process_images', stdout=StringIO())
+
+        self.assertEqual(Images.objects.filter(status=Images.FAILED, raw_image='').count(), 5)
+        self.assertFalse(any(Images.raw_image.field.storage.exists(name) for name in raw_images))
+
+
+@override_settings(IMAGE_STORAGE_ROOT=tempfile.mkdtemp())
+class TestDeleteImages(TestCase):
+    def setUp(self):
+        self.storage = get_image_storage()
+        self.names = [self.storage.save(create_test_image(size)).name for size in ((10, 10), (20, 20))]
+        ImageDeletion.objects.schedule(self.names)
+
+    def test_delete(self):
+        out = StringIO()
+        call_command('delete_images', batch_size=1, stdout=out)
+
+        self.assertEqual([self.storage.storage.exists(name) for name in self.names], [False, True])
+        self.assertEqual(ImageDeletion.objects.count(), 1)
+        self.assertIn('Deleted 1 images.', out.getvalue())
+
+    def test_referenced_image_is_kept(self):
+        ImageAsset.objects.create(kind=ImageAsset.POST_IMAGE, content_hash='foo', image=self.names[0])
+        call_command('delete_images', stdout=StringIO())
+
+        self.assertTrue(self.storage.storage.exists(self.names[0]))
+        self.assertFalse(ImageDeletion.objects.exists())
+
+    @patch.object(LocalImageStorage, 'delete', side_effect=Exception('Storage is unavailable'))
+    def test_failed_batch_is_retried_later(self, delete):
+        for attempt in range(1, 3):
+            ImageDeletion.objects.update(next_attempt_at=timezone.now())
+            with self.assertLogs('dj_gram.management.commands.delete_images', 'ERROR'):
+                call_command('delete_images', stdout=StringIO())
+
+            deletion = ImageDeletion.objects.first()
+            self.assertEqual(deletion.attempts, attempt)
+            self.assertGreater(deletion.next_attempt_at, timezone.now() + deletion.get_retry_delay() * 0.9)
+
+        self.assertEqual(ImageDeletion(attempts=2).get_retry_delay().total_seconds(), ImageDeletion.retry_delay * 2)
+        self.assertEqual(ImageDeletion(attempts=20).get_retry_delay().total_seconds(), ImageDeletion.max_retry_delay)
+
+        call_command('delete_images', stdout=StringIO())
+        self.assertEqual(ImageDeletion.objects.count(), 2)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TestPurgeAccounts(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user, follower, followed = [CustomUser.objects.create_user(email=f'user{i}@foo.foo') for i in range(3)]
+        Follow.objects.create(user=follower, followed_id=user)
+        Follow.objects.create(user=user, followed_id=followed)
+        CustomUser.objects.filter(pk__in=[follower.pk, user.pk]).update(follow_count=1)
+        CustomUser.objects.filter(pk__in=[user.pk, followed.pk]).update(followed_count=1)
+
+        other_post = Post.objects.create(user=followed, like_count=1, dislike_count=1)
+        Vote.objects.create(user=user, post=other_post, vote=True)
+        Vote.objects.create(user=follower, post=other_post, vote=False)
+        for _ in range(3):
+            post = Post.objects.create(user=user, like_count=1)
+            Vote.objects.create(user=follower, post=post, vote=True)
+            TimelineEntry.objects.fan_out(post)
+            Images.objects.create(post=post, image=create_test_image())
+
+    def setUp(self):
+        self.user, self.follower, self.followed = CustomUser.objects.order_by('id')
+
+    def test_account_is_purged_only_after_request(self):
+        call_command('purge_accounts', stdout=StringIO())
+        self.assertTrue(CustomUser.objects.filter(pk=self.user.pk).exists())
+
+    def test_purge(self):
+        self.user.request_deletion()
+        out = StringIO()
+        call_command('purge_accounts', chunk_size=2, stdout=out)
+
+        self.assertFalse(CustomUser.objects.filter(pk=self.user.pk).exists())
+        self.assertFalse(Post.objects.filter(user_id=self.user.pk).exists())
+        self.assertFalse(ImageAsset.objects.exists())
+        self.assertEqual(ImageDeletion.objects.count(), 1)
+        self.assertEqual(Vote.objects.count(), 1)
+        self.assertFalse(TimelineEntry.objects.exists())
+
+        self.follower.refresh_from_db()
+        self.followed.refresh_from_db()
+        self.assertEqual((self.follower.follow_count, self.followed.followed_count), (0, 0))
+        post = self.followed.posts.get()
+        self.assertEqual((post.like_count, post.dislike_count), (0, 1))
+
+        self.assertIn(f'User {self.user.pk}: deleted 2 posts.', out.getvalue())
+        self.assertIn(f'User {self.user.pk}: deleted 3 posts.', out.getvalue())
+        self.assertIn(f'Purged user {self.user.pk}.', out.getvalue())
+
+    def test_purge_follow_suggestions(self):
+        FollowSuggestion.objects.bulk_create([
+            FollowSuggestion(user=self.user, suggested=self.followed, score=1),
+            FollowSuggestion(user=self.user, suggested=self.follower, score=1),
+            FollowSuggestion(user=self.follower, suggested=self.user, score=1),
+            FollowSuggestion(user=self.follower, suggested=self.followed, score=1),
+        ])
+        self.user.request_deletion()
+        out = StringIO()
+        call_command('purge_accounts', chunk_size=1, stdout=out)
+
+        self.assertEqual(list(FollowSuggestion.objects.values_list('user_id', 'suggested_id')),
+                         [(self.follower.pk, self.followed.pk)])
+        self.assertIn(f'User {self.user.pk}: deleted 2 follow suggestions.', out.getvalue())
+        self.assertIn(f'User {self.user.pk}: deleted 1 suggestions of the account.', out.getvalue())
+
+    @patch.object(settings, 'FOLLOWER_COUNT_SHARDS', 4)
+    @patch.object(TimelineEntry, 'fan_out_followers_threshold', 1)
+    def test_purge_with_follower_count_shards(self):
+        author = CustomUser.objects.create_user(email='author@foo.foo')
+        fans = [CustomUser.objects.create_user(email=f'fan{i}@foo.foo') for i in range(4)]
+        for fan in fans:
+            Follow.objects.follow(fan, CustomUser.objects.get(pk=author.pk))
+        self.assertTrue(author.follower_count_shards.exists())
+
+        fans[-1].request_deletion()
+        call_command('purge_accounts', stdout=StringIO())
+
+        author.refresh_from_db()
+        self.assertEqual(author.get_followed_count(), 3)
+        self.assertFalse(TimelineEntry.objects.is_fanned_out(author))
+
+    def test_interrupted_purge_resumes(self):
+        self.user.request_deletion()
+        with patch.object(CustomUserManager, '_release_votes', side_effect=Exception('Connection lost')):
+            with self.assertLogs('dj_gram.management.commands.purge_accounts', 'ERROR'):
+                call_command('purge_accounts', stdout=StringIO())
+
+        self.assertFalse(Follow.objects.exists())
+        self.follower.refresh_from_db()
+        self.assertEqual(self.follower.follow_count, 0)
+
+        call_command('purge_accounts', stdout=StringIO())
+        self.assertFalse(CustomUser.objects.filter(pk=self.user.pk).exists())
+        self.follower.refresh_from_db()
+        self.assertEqual(self.follower.follow_count, 0)
+
+
+class TestComputeSuggestions(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = [CustomUser.objects.create_user(email=f'user{i}@foo.foo', is_active=True) for i in range(5)]
+        for user, followed in [(0, 1), (0, 2), (1, 2), (1, 3), (2, 3), (2, 0), (3, 4)]:
+            Follow.objects.follow(users[user], users[followed])
+
+    def setUp(self):
+        self.users = list(CustomUser.objects.order_by('id'))
+        self.settings = override_settings(FOLLOW_GRAPH_ROOT=tempfile.mkdtemp())
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        call_command('build_follow_graph', stdout=StringIO())
+
+    def get_suggestions(self, user):
+        return [(suggestion.suggested, suggestion.score) for suggestion in FollowSuggestion.objects.for_user(user)]
+
+    def test_compute(self):
+        out = StringIO()
+        with patch.object(FollowSuggestion, 'max_per_user', 1):
+            call_command('compute_suggestions', chunk_size=3, stdout=out)
+
+        self.assertEqual(self.get_suggestions(self.users[0]), [(self.users[3], 2)])
+        self.assertEqual(self.get_suggestions(self.users[1]), [(self.users[0], 1)])
+        self.assertEqual(self.get_suggestions(self.users[2]), [(self.users[1], 1)])
+        self.assertEqual(self.get_suggestions(self.users[3]), [])
+        self.assertIn('Refreshed suggestions of 4 users.', out.getvalue())
+
+    def test_closed_accounts_are_not_suggested(self):
+        self.users[0].request_deletion()
+        call_command('compute_suggestions', stdout=StringIO())
+
+        self.assertEqual(self.get_suggestions(self.users[1]), [(self.users[4], 1)])
+        self.assertFalse(FollowSuggestion.objects.filter(user=self.users[0]).exists())
+
+    def test_follows_are_refreshed_incrementally(self):
+        def follow(seconds):
+            if follow.called:
+                raise KeyboardInterrupt
+            follow.called = True
+            with self.captureOnCommitCallbacks(execute=True):
+                Follow.objects.follow(self.users[0], self.users[3])
+                Follow.objects.follow(self.users[2], self.users[4])
+            # the followed account leaves suggestions as soon as it's followed
+            self.assertEqual(self.get_suggestions(self.users[0]), [])
+        follow.called = False
+
+        out = StringIO()
+        with patch('time.sleep', side_effect=follow), self.assertRaises(KeyboardInterrupt):
+            call_command('compute_suggestions', loop=True, stdout=out)
+
+        self.assertEqual(self.get_suggestions(self.users[0]), [(self.users[4], 2)])
+        # user 1 follows user 2, who has followed user 4
+        self.assertEqual(self.get_suggestions(self.users[1]), [(self.users[4], 2), (self.users[0], 1)])
+        self.assertIn('Refreshed suggestions of 3 users.', out.getvalue())
+        self.assertNotIn('Built generation 2', out.getvalue())
+
+    def test_snapshot_is_built(self):
+        with override_settings(FOLLOW_GRAPH_ROOT=tempfile.mkdtemp()):
+            out = StringIO()
+            call_command('compute_suggestions', stdout=out)
+            self.assertIn('Built generation 1 of 4 users and 7 follows.', out.getvalue())
+
+            with patch('time.time', return_value=time.time() + 7200):
+                call_command('compute_suggestions', stdout=out)
+            self.assertIn('Built generation 2', out.getvalue())
+
+        self.assertEqual(self.get_suggestions(self.users[0]), [(self.users[3], 2)])
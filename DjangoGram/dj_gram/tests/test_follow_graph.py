@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from dj_gram import follow_graph
+from dj_gram.follow_graph import FollowGraph, get_follow_graph
+from dj_gram.models import *
+
+
+class TestFollowGraph(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = [CustomUser.objects.create_user(email=f'user{i}@foo.foo') for i in range(5)]
+        for user, followed in [(0, 1), (0, 2), (1, 2), (1, 3), (2, 3), (2, 0), (3, 4)]:
+            Follow.objects.follow(users[user], users[followed])
+
+    def setUp(self):
+        self.ids = list(CustomUser.objects.order_by('id').values_list('id', flat=True))
+        root = tempfile.mkdtemp()
+        self.settings = override_settings(FOLLOW_GRAPH_ROOT=root)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+        out = StringIO()
+        call_command('build_follow_graph', chunk_size=2, stdout=out)
+        self.assertIn('Built generation 1 of 4 users and 7 follows.', out.getvalue())
+        self.graph = FollowGraph(root, 1)
+
+    def test_follows(self):
+        self.assertTrue(self.graph.follows(self.ids[0], self.ids[2]))
+        self.assertFalse(self.graph.follows(self.ids[2], self.ids[1]))
+        self.assertFalse(self.graph.follows(self.ids[4], self.ids[0]))  # user without follows
+        self.assertTrue(self.graph.is_mutual(self.ids[0], self.ids[2]))
+        self.assertFalse(self.graph.is_mutual(self.ids[0], self.ids[1]))
+
+    def test_lookups_dont_query(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.graph.get_followed_ids(self.ids[1]), [self.ids[2], self.ids[3]])
+            self.assertEqual(self.graph.get_followed_by_followed(self.ids[0]), {self.ids[3]: 2})
+
+    def test_delta_log(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.follow(CustomUser.objects.get(pk=self.ids[4]), CustomUser.objects.get(pk=self.ids[0]))
+            Follow.objects.unfollow(CustomUser.objects.get(pk=self.ids[0]), CustomUser.objects.get(pk=self.ids[1]))
+        self.assertEqual(self.graph.apply_delta_log(), {self.ids[4], self.ids[0]})
+
+        self.assertTrue(self.graph.follows(self.ids[4], self.ids[0]))
+        self.assertFalse(self.graph.follows(self.ids[0], self.ids[1]))
+        self.assertEqual(self.graph.get_followed_ids(self.ids[0]), [self.ids[2]])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.follow(CustomUser.objects.get(pk=self.ids[0]), CustomUser.objects.get(pk=self.ids[1]))
+        self.graph.apply_delta_log()
+        self.assertTrue(self.graph.follows(self.ids[0], self.ids[1]))
+
+    def test_rebuild_starts_new_generation(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.follow(CustomUser.objects.get(pk=self.ids[4]), CustomUser.objects.get(pk=self.ids[0]))
+        call_command('build_follow_graph', stdout=StringIO())
+        call_command('build_follow_graph', stdout=StringIO())
+
+        graph = get_follow_graph(refresh_interval=0)
+        self.assertEqual(graph.generation, 3)
+        self.assertTrue(graph.follows(self.ids[4], self.ids[0]))
+        self.assertEqual(sorted(os.listdir(self.graph.root)), ['2.graph', '2.log', '3.graph', '3.log', 'CURRENT'])
+
+    def test_half_written_record_is_applied_later(self):
+        record = follow_graph.DELTA.pack(self.ids[4], self.ids[1])
+        with open(follow_graph.get_delta_log_path(self.graph.root, 1), 'ab') as log:
+            log.write(record[:5])
+        self.graph.apply_delta_log()
+        self.assertFalse(self.graph.follows(self.ids[4], self.ids[1]))
+
+        with open(follow_graph.get_delta_log_path(self.graph.root, 1), 'ab') as log:
+            log.write(record[5:])
+        self.graph.apply_delta_log()
+        self.assertTrue(self.graph.follows(self.ids[4], self.ids[1]))
+
+    @override_settings(FOLLOW_GRAPH_ROOT=tempfile.mkdtemp())
+    def test_not_built(self):
+        self.assertIsNone(get_follow_graph(refresh_interval=0))
+        with patch('os.open') as open_log:
+            follow_graph.log_delta(1, 2, followed=True)
+        open_log.assert_not_called()
+
+
+class TestFollowGraphIsPrivate(TestCase):
+    def test_not_under_media_root(self):
+        media_root = os.path.join(os.path.abspath(settings.MEDIA_ROOT), '')
+        self.assertFalse(os.path.abspath(settings.FOLLOW_GRAPH_ROOT).startswith(media_root))
+
+    def test_not_served(self):
+        created_root = settings.FOLLOW_GRAPH_ROOT
+        while not os.path.exists(os.path.dirname(created_root)):
+            created_root = os.path.dirname(created_root)
+        if not os.path.exists(created_root):
+            self.addCleanup(shutil.rmtree, created_root, ignore_errors=True)
+        call_command('build_follow_graph', stdout=StringIO())
+
+        for name in os.listdir(settings.FOLLOW_GRAPH_ROOT):
+            with self.subTest(name=name):
+                self.assertEqual(self.client.get(f'/media/follow_graph/{name}').status_code, 404)
+                relative_path = os.path.relpath(os.path.join(settings.FOLLOW_GRAPH_ROOT, name), settings.MEDIA_ROOT)
+                self.assertEqual(self.client.get(f'/media/{relative_path}').status_code, 400)  # outside of the root
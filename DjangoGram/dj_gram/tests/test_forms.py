@@ -1,5 +1,9 @@
+import tempfile
+from unittest.mock import patch
+
+from django.db import DatabaseError
 from django.forms import PasswordInput
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils.datastructures import MultiValueDict
 
 from dj_gram.forms import *
@@ -34,6 +38,33 @@ class TestImageForm(TestCase):
 
         self.assertFalse(form.is_valid())
 
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_save_defers_processing(self):
+        post = Post.objects.create(user=CustomUser.objects.create_user(email='foo@foo.foo'))
+        files = MultiValueDict({'image': [create_test_image().open(), create_test_image().open()]})
+        form = ImageForm(data=None, files=files)
+        form.is_valid()
+        form.save(post=post)
+
+        for image in post.images.all():
+            with self.subTest(image=image.id):
+                self.assertEqual(image.status, Images.PROCESSING)
+                self.assertFalse(image.image)
+                self.assertTrue(image.raw_image.storage.exists(image.raw_image.name))
+
+    @override_settings(RAW_IMAGE_ROOT=tempfile.mkdtemp())
+    def test_save_removes_stored_images_on_failure(self):
+        post = Post.objects.create(user=CustomUser.objects.create_user(email='foo@foo.foo'))
+        files = MultiValueDict({'image': [create_test_image().open(), create_test_image().open()]})
+        form = ImageForm(data=None, files=files)
+        form.is_valid()
+
+        with patch.object(ImagesManager, 'bulk_create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                form.save(post=post)
+
+        self.assertEqual(Images.raw_image.field.storage.listdir('raw_images'), ([], []))
+
 
 class TestCustomUserCreationForm(TestCase):
     def test_fields_is_email(self):
@@ -0,0 +1,108 @@
+import hashlib
+import tempfile
+from unittest.mock import call, patch
+
+from django.test import TestCase, override_settings
+
+from dj_gram.image_storage import CloudinaryImageStorage, LocalImageStorage, StoredImage, get_image_storage, \
+    get_image_url_cache_info
+from .conf import create_test_image
+
+
+@override_settings(IMAGE_STORAGE_BACKEND='dj_gram.image_storage.LocalImageStorage',
+                   IMAGE_STORAGE_ROOT=tempfile.mkdtemp())
+class TestLocalImageStorage(TestCase):
+    eager = [{'width': 48, 'height': 48, 'crop': 'fill', 'gravity': 'center'},
+             {'width': 32, 'crop': 'limit', 'format': 'webp'}]
+
+    def setUp(self):
+        self.storage = get_image_storage()
+        self.file = create_test_image((100, 50))
+        self.stored = self.storage.save(self.file, eager=self.eager, folder='ignored')
+
+    def test_get_image_storage(self):
+        self.assertIsInstance(self.storage, LocalImageStorage)
+
+    def test_content_addressed_name(self):
+        digest = hashlib.sha256(self.file.open().read()).hexdigest()
+
+        self.assertEqual(self.stored.name, f'{digest[:2]}/{digest[2:4]}/{digest}.jpg')
+        self.assertEqual(self.stored.metadata, {'width': 100, 'height': 50})
+        self.assertEqual(self.storage.save(create_test_image((100, 50))), self.stored)
+
+    def test_renditions(self):
+        self.assertTrue(self.storage.storage.exists(self.stored.name.replace(
+            '.jpg', '_crop-fill_gravity-center_height-48_width-48.jpg')))
+        self.assertEqual(self.stored.build_url(**self.eager[1]),
+                         '/images/' + self.stored.name.replace('.jpg', '_crop-limit_width-32.webp'))
+
+    def test_delete(self):
+        other = self.storage.save(create_test_image((10, 10)))
+        self.storage.delete([self.stored.name])
+
+        directory = self.stored.name.rsplit('/', 1)[0]
+        self.assertEqual(self.storage.storage.listdir(directory), ([], []))
+        self.assertTrue(self.storage.storage.exists(other.name))
+
+    def test_serve(self):
+        response = self.client.get(self.stored.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.file.open().read())
+        self.assertIn('immutable', response['Cache-Control'])
+
+    @override_settings(IMAGE_STORAGE_ACCEL_REDIRECT_URL='/protected-images/')
+    def test_serve_x_accel_redirect(self):
+        response = self.client.get(self.stored.url)
+
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-images/' + self.stored.name)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response.content, b'')
+
+    def test_serve_missing(self):
+        response = self.client.get('/images/00/00/missing.jpg')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(IMAGE_STORAGE_BACKEND='dj_gram.image_storage.CloudinaryImageStorage')
+class TestCloudinaryImageStorage(TestCase):
+    def test_get_image_storage(self):
+        self.assertIsInstance(get_image_storage(), CloudinaryImageStorage)
+
+    def test_url(self):
+        image = StoredImage('image/upload/v1/images/posts/sample.jpg')
+
+        self.assertTrue(image.url.endswith('/image/upload/v1/images/posts/sample.jpg'))
+        self.assertTrue(image.build_url(width=320, crop='limit', format='webp')
+                        .endswith('/image/upload/c_limit,w_320/v1/images/posts/sample.webp'))
+
+    def test_serve_image_is_not_found(self):
+        response = self.client.get('/images/image/upload/v1/images/posts/sample.jpg')
+        self.assertEqual(response.status_code, 404)
+
+    @patch('cloudinary.api.delete_resources')
+    def test_delete_in_batches(self, delete_resources):
+        names = [f'image/upload/v1/images/posts/{i}.jpg' for i in range(150)] + ['image/private/v1/secret.jpg']
+        get_image_storage().delete(names)
+
+        self.assertEqual(delete_resources.call_args_list, [
+            call(['secret'], type='private', resource_type='image', invalidate=True),
+            call([f'images/posts/{i}' for i in range(100)], type='upload', resource_type='image', invalidate=True),
+            call([f'images/posts/{i}' for i in range(100, 150)], type='upload', resource_type='image', invalidate=True),
+        ])
+
+    def test_url_is_memoized(self):
+        image = StoredImage('image/upload/v1/images/posts/memo.jpg')
+        url = image.build_url(width=320, crop='limit')
+        info = get_image_url_cache_info()
+
+        with patch.object(CloudinaryImageStorage, 'url') as build_url:
+            self.assertEqual(image.build_url(crop='limit', width=320), url)
+        build_url.assert_not_called()
+        self.assertEqual(get_image_url_cache_info().hits, info.hits + 1)
+
+    def test_memo_is_cleared_with_storage(self):
+        url = StoredImage('image/upload/v1/images/posts/memo.jpg').url
+
+        with override_settings(IMAGE_STORAGE_BACKEND='dj_gram.image_storage.LocalImageStorage'):
+            self.assertNotEqual(StoredImage('image/upload/v1/images/posts/memo.jpg').url, url)
@@ -1,5 +1,16 @@
-from django.test import TestCase
-
+import os
+import tempfile
+from io import BytesIO
+from itertools import count
+from unittest.mock import ANY, patch
+
+from PIL import Image
+from PIL.JpegImagePlugin import JpegImageFile
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.test import TestCase, override_settings
+
+from dj_gram.image_storage import LocalImageStorage
 from dj_gram.models import *
 from .conf import create_test_image
 
@@ -73,11 +84,6 @@ class TestCustomUserModel(TestCase):
         max_length = CustomUser._meta.get_field('bio').max_length
         self.assertEqual(max_length, 512)
 
-    # testing avatar
-    def test_customuser_avatar_url(self):
-        avatar_url = self.user.avatar_public_id()
-        self.assertTrue(f'{self.user.pk}_{self.user.first_name}_{self.user.last_name}' in avatar_url)
-
     #  testing user creation
     def test_customuser_create_user_default_kwargs(self):
         self.assertFalse(self.user.is_superuser)
@@ -122,6 +128,41 @@ class TestTag(TestCase):
                 tag_name = '#tag' + str(tag)
                 self.post.tags.add(Tag.objects.create(name=tag_name))
 
+    def test_add_to_post(self):
+        Tag.objects.clear_id_cache()
+        names = ['Foo', 'bar', 'must be low_case', 'foo']
+        # tags insert, tags lookup, existing through rows, tag slots update, through rows insert, 4 savepoint queries
+        with self.assertNumQueries(9):
+            self.assertEqual(Tag.objects.add_to_post(self.post, names), [])
+
+        self.assertEqual(set(self.post.tags.values_list('name', flat=True)), {'foo', 'bar', 'must be low_case'})
+
+    def test_add_to_post_over_limit(self):
+        names = [f'tag{i}' for i in range(Post.max_tags_count + 2)]
+        self.post.tags.add(Tag.objects.get(name='must be low_case'))
+
+        self.assertEqual(Tag.objects.add_to_post(self.post, names), names[-3:])
+        self.assertEqual(self.post.tags.count(), Post.max_tags_count)
+
+    def test_tag_ids_are_cached_after_commit(self):
+        Tag.objects.clear_id_cache()
+        self.addCleanup(Tag.objects.clear_id_cache)  # the test transaction is rolled back
+        with self.captureOnCommitCallbacks(execute=True):
+            ids = Tag.objects.get_ids(['foo', 'must be low_case'])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Tag.objects.get_ids(['foo', 'must be low_case']), ids)
+
+        with patch.object(TagManager, 'id_cache_size', 1):
+            with self.captureOnCommitCallbacks(execute=True):
+                Tag.objects.get_ids(['bar'])
+        with self.assertNumQueries(2):
+            Tag.objects.get_ids(['foo'])
+
+        Tag.objects.get(name='foo').delete()
+        with self.assertNumQueries(2):
+            Tag.objects.get_ids(['bar'])
+
 
 class TestImages(TestCase):
     @classmethod
@@ -152,6 +193,241 @@ class TestImages(TestCase):
         self.assertEqual(thumbnailed_image_size, (960, 720))
 
 
+@override_settings(IMAGE_STORAGE_BACKEND='dj_gram.image_storage.CloudinaryImageStorage')
+class TestCustomUserAvatar(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CustomUser.objects.create_user(email='foo@foo.foo', avatar='image/upload/v1/avatar.jpg')
+        CustomUser.objects.create_user(email='bar@bar.bar')
+
+    def test_get_avatar_url(self):
+        user = CustomUser.objects.get(email='foo@foo.foo')
+
+        self.assertIn('/c_fill,g_center,h_48,w_48/v1/avatar.jpg', user.get_avatar_url(30))
+        self.assertIn('/c_fill,g_center,h_150,w_150/', user.get_avatar_url(60))
+        self.assertIn('/c_fill,g_center,h_320,w_320/', user.get_avatar_url(200))
+        self.assertIn('/c_fill,g_center,h_320,w_320/', user.get_avatar_url(1000))
+
+    def test_get_avatar_url_without_avatar(self):
+        self.assertEqual(CustomUser.objects.get(email='bar@bar.bar').get_avatar_url(30), '')
+
+
+class TestImageThumbnailMixin(TestCase):
+    def test_size_is_size_of_file(self):
+        image = create_test_image((2000, 1500))
+        ImageThumbnailMixin.make_thumbnail(image)
+
+        self.assertEqual(image.size, len(image.read()))
+
+    def test_jpeg_is_scaled_while_decoding(self):
+        image = create_test_image((4000, 3000))
+        with patch.object(JpegImageFile, 'draft', autospec=True, side_effect=JpegImageFile.draft) as draft:
+            ImageThumbnailMixin.make_thumbnail(image)
+
+        draft.assert_called_once_with(ANY, 'RGB', ImageThumbnailMixin.acceptable_image_size)
+        self.assertEqual(Image.open(image).size, (960, 720))
+
+    def test_exif_orientation_is_applied(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # rotated 90 degrees clockwise
+        temp = BytesIO()
+        Image.new('RGB', (2000, 1500)).save(temp, 'jpeg', exif=exif)
+        image = create_test_image()
+        image.file = temp
+
+        ImageThumbnailMixin.make_thumbnail(image)
+
+        self.assertEqual(Image.open(image).size, (540, 720))
+
+    def test_avatar_is_cropped_to_square(self):
+        image = create_test_image((2000, 1500))
+        CustomUser.make_thumbnail(image)
+
+        self.assertEqual(Image.open(image).size, (320, 320))
+
+    def test_png_is_converted_to_jpeg(self):
+        temp = BytesIO()
+        Image.new('RGBA', (2000, 1500)).save(temp, 'png')
+        image = create_test_image()
+        image.file = temp
+
+        ImageThumbnailMixin.make_thumbnail(image)
+
+        thumbnail = Image.open(image)
+        self.assertEqual((thumbnail.format, thumbnail.mode, thumbnail.size), ('JPEG', 'RGB', (960, 720)))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TestImagesProcessing(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user(email='tests@tests.tests')
+        Post.objects.create(user=user)
+
+    def setUp(self):
+        self.post = Post.objects.first()
+        self.image = Images.objects.create(post=self.post, raw_image=create_test_image((2000, 1500)),
+                                           status=Images.PROCESSING)
+
+    def test_status_default(self):
+        self.assertEqual(Images._meta.get_field('status').default, Images.READY)
+
+    def test_processing_image_is_not_uploaded(self):
+        self.assertFalse(self.image.image)
+        self.assertFalse(self.image.is_ready)
+
+    def test_process(self):
+        raw_image_name = self.image.raw_image.name
+        self.image.process()
+        self.image.refresh_from_db()
+
+        storage = get_image_storage().storage
+        self.assertEqual(Image.open(storage.open(self.image.image.name)).size, (960, 720))
+        self.assertTrue(self.image.is_ready)
+        self.assertEqual((self.image.width, self.image.height), (960, 720))
+        for transformation in self.image.get_eager_transformations():
+            with self.subTest(transformation=transformation):
+                self.assertTrue(storage.exists(LocalImageStorage.get_rendition_name(self.image.image.name,
+                                                                                    transformation)))
+        self.assertFalse(self.image.raw_image)
+        self.assertFalse(Images.raw_image.field.storage.exists(raw_image_name))
+
+    def test_raw_image_is_private(self):
+        media_root = os.path.join(os.path.abspath(settings.MEDIA_ROOT), '')
+        self.assertFalse(os.path.abspath(settings.RAW_IMAGE_ROOT).startswith(media_root))
+        self.assertFalse(self.image.raw_image.path.startswith(os.path.join(default_storage.location, '')))
+
+    def test_renditions(self):
+        self.assertEqual(self.image.renditions, [])
+
+        self.image.width, self.image.height = 960, 720
+        self.assertEqual(self.image.renditions, [(320, 320, 240), (640, 640, 480), (1280, 960, 720)])
+
+        self.image.width, self.image.height = 640, 360
+        self.assertEqual(self.image.renditions, [(320, 320, 180), (640, 640, 360)])
+
+    @override_settings(IMAGE_STORAGE_ROOT=tempfile.mkdtemp())
+    def test_process_post_images_partial_failure(self):
+        images = [self.image, Images.objects.create(post=self.post, raw_image=create_test_image(),
+                                                    status=Images.PROCESSING)]
+        save = LocalImageStorage.save
+        calls = count()
+
+        def fail_second_save(storage, file, **options):
+            if next(calls):
+                raise Exception('Timeout')
+            return save(storage, file, **options)
+
+        with patch.object(LocalImageStorage, 'save', autospec=True, side_effect=fail_second_save):
+            with self.assertRaises(Exception):
+                Images.objects.process(images)
+
+        ImageDeletion.objects.drain()
+        stored_files = [files for _, _, files in os.walk(get_image_storage().storage.location) if files]
+        self.assertEqual(stored_files, [])
+        for image in Images.objects.filter(post=self.post):
+            with self.subTest(image=image.id):
+                self.assertEqual(image.status, Images.PROCESSING)
+                self.assertFalse(image.image)
+                self.assertTrue(Images.raw_image.field.storage.exists(image.raw_image.name))
+
+    def test_save_ready_image_of_full_post(self):
+        Images.objects.bulk_create([Images(post=self.post, image='sample')
+                                    for _ in range(Images.max_count_images_in_post - 1)])
+        self.image.process()
+
+        self.assertTrue(self.image.is_ready)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TestImageAsset(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user(email='tests@tests.tests')
+        Post.objects.create(user=user)
+
+    def setUp(self):
+        self.user = CustomUser.objects.get(email='tests@tests.tests')
+        self.post = Post.objects.first()
+
+    def test_referenced_names_are_indexed(self):
+        for model, field in [(ImageAsset, 'image'), (Images, 'image'), (CustomUser, 'avatar')]:
+            with self.subTest(model=model.__name__):
+                self.assertTrue(model._meta.get_field(field).db_index)
+
+    def create_processing_images(self, sizes):
+        return [Images.objects.create(post=self.post, raw_image=create_test_image(size), status=Images.PROCESSING)
+                for size in sizes]
+
+    @override_settings(IMAGE_STORAGE_ROOT=tempfile.mkdtemp())
+    def test_same_content_is_uploaded_once(self):
+        with patch.object(LocalImageStorage, 'save', autospec=True, side_effect=LocalImageStorage.save) as save:
+            Images.objects.process(self.create_processing_images([(100, 100), (100, 100), (50, 50)]))
+            Images.objects.process(self.create_processing_images([(100, 100)]))
+
+        self.assertEqual(save.call_count, 2)
+        self.assertEqual(ImageAsset.objects.count(), 2)
+        self.assertEqual(ImageAsset.objects.get(width=100).ref_count, 3)
+        self.assertEqual(Images.objects.filter(asset__width=100, status=Images.READY).count(), 3)
+
+    @override_settings(IMAGE_STORAGE_ROOT=tempfile.mkdtemp())
+    def test_save_uploaded_image(self):
+        with patch.object(LocalImageStorage, 'save', autospec=True, side_effect=LocalImageStorage.save) as save:
+            images = [Images.objects.create(post=self.post, image=create_test_image()) for _ in range(2)]
+
+        save.assert_called_once()
+        self.assertEqual(images[0].asset, images[1].asset)
+        self.assertEqual(images[0].image, images[1].image)
+        self.assertEqual(images[1].asset.ref_count, 2)
+
+    @override_settings(IMAGE_STORAGE_ROOT=tempfile.mkdtemp())
+    def test_stored_image_is_deleted_with_last_reference(self):
+        images = self.create_processing_images([(100, 100), (100, 100)])
+        Images.objects.process(images)
+        name = images[0].image.name
+        storage = get_image_storage().storage
+
+        images[0].delete()
+        self.assertFalse(ImageDeletion.objects.exists())
+        self.assertEqual(ImageAsset.objects.get().ref_count, 1)
+
+        images[1].delete()
+        self.assertTrue(storage.exists(name))
+        ImageDeletion.objects.drain()
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(ImageAsset.objects.exists())
+
+    @override_settings(IMAGE_STORAGE_ROOT=tempfile.mkdtemp())
+    def test_avatar_is_shared(self):
+        other_user = CustomUser.objects.create_user(email='other@tests.tests')
+        for user in (self.user, other_user):
+            user.avatar = create_test_image()
+            user.save(update_fields=['avatar'])
+
+        self.assertEqual(self.user.avatar_asset, other_user.avatar_asset)
+        self.assertEqual(CustomUser.objects.get(pk=other_user.pk).avatar, self.user.avatar)
+        self.assertEqual(ImageAsset.objects.get(kind=ImageAsset.AVATAR).ref_count, 2)
+
+    @override_settings(IMAGE_STORAGE_ROOT=tempfile.mkdtemp())
+    def test_changed_avatar_releases_previous(self):
+        self.user.avatar = create_test_image()
+        self.user.save(update_fields=['avatar'])
+        previous = self.user.avatar.name
+
+        temp = BytesIO()
+        Image.new('RGB', (100, 100), 'white').save(temp, 'jpeg')
+        self.user.avatar = create_test_image()
+        self.user.avatar.file = temp
+        self.user.save(update_fields=['avatar'])
+        ImageDeletion.objects.drain()
+
+        self.assertEqual(ImageAsset.objects.get().pk, self.user.avatar_asset_id)
+        self.assertFalse(get_image_storage().storage.exists(previous))
+
+        self.user.delete()
+        self.assertFalse(ImageAsset.objects.exists())
+
+
 class TestVote(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -207,6 +483,60 @@ class TestVote(TestCase):
         unique_together = Vote._meta.unique_together[0]
         self.assertEqual(unique_together, ('user', 'post'))
 
+    #  testing get_votes_map
+    def test_get_votes_map(self):
+        disliked_post = Post.objects.create(user=self.user)
+        not_voted_post = Post.objects.create(user=self.user)
+        Vote.objects.create(user=self.user, post=disliked_post, vote=False)
+
+        votes = Vote.objects.get_votes_map(user=self.user, posts=[self.post, disliked_post, not_voted_post])
+        self.assertEqual(votes, {self.post.id: True, disliked_post.id: False})
+
+    def test_get_votes_map_ignores_other_users(self):
+        user = CustomUser.objects.create_user(email='foo@foo.foo')
+        votes = Vote.objects.get_votes_map(user=user, posts=[self.post])
+        self.assertEqual(votes, {})
+
+    def test_get_votes_map_one_query(self):
+        posts = [Post.objects.create(user=self.user) for _ in range(10)]
+        for post in posts:
+            Vote.objects.create(user=self.user, post=post, vote=True)
+
+        with self.assertNumQueries(1):
+            Vote.objects.get_votes_map(user=self.user, posts=posts)
+
+    def test_get_votes_map_empty_posts(self):
+        with self.assertNumQueries(0):
+            votes = Vote.objects.get_votes_map(user=self.user, posts=[])
+        self.assertEqual(votes, {})
+
+
+class TestVoteManager(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user(email='tests@tests.tests')
+        Post.objects.create(user=user)
+
+    def setUp(self):
+        self.user = CustomUser.objects.get(email='tests@tests.tests')
+        self.post = self.user.posts.first()
+
+    def test_toggle(self):
+        self.assertEqual(Vote.objects.toggle(self.user, self.post, True), (1, 0, True))
+        self.assertEqual(Vote.objects.toggle(self.user, self.post, False), (0, 1, False))
+        self.assertEqual(Vote.objects.toggle(self.user, self.post, False), (0, 0, None))
+        self.assertFalse(Vote.objects.exists())
+
+    def test_concurrent_insert_is_upserted(self):
+        # a concurrent request commits the same vote between the lookup and the insert
+        Vote.objects.create(user=self.user, post=self.post, vote=True)
+        self.post.update_vote_counters(likes=1)
+
+        with patch.object(models.QuerySet, 'first', return_value=None):
+            self.assertEqual(Vote.objects.toggle(self.user, self.post, True), (0, 0, None))
+
+        self.assertFalse(Vote.objects.exists())
+
 
 class TestPost(TestCase):
     @classmethod
@@ -279,6 +609,121 @@ class TestPost(TestCase):
         self.assertEqual(likes_count, 2)
         self.assertEqual(dislikes_count, 1)
 
+    #  testing vote counters
+    def test_post_vote_counters_default(self):
+        post = Post.objects.create(user=self.user)
+        self.assertEqual((post.like_count, post.dislike_count), (0, 0))
+
+    def test_post_update_vote_counters(self):
+        self.post.update_vote_counters(likes=2, dislikes=1)
+        self.post.update_vote_counters(likes=-1)
+        self.post.refresh_from_db()
+
+        self.assertEqual((self.post.like_count, self.post.dislike_count), (1, 1))
+
+
+class TestPostLimits(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Post.objects.create(user=CustomUser.objects.create_user(email='tests@tests.tests'))
+
+    def setUp(self):
+        self.post = Post.objects.get()
+
+    def test_image_limit(self):
+        self.post.reserve_slots(images=Post.max_images_count - 1)
+        Images.objects.create(post=self.post, image='sample')
+
+        with self.assertRaisesMessage(ValidationError, f'more than {Post.max_images_count} images'):
+            Images.objects.create(post=self.post, image='sample')
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.image_count, Post.max_images_count)
+
+        self.post.images.first().delete()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.image_count, Post.max_images_count - 1)
+
+    def test_tag_limit_is_a_check_constraint(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Post.objects.filter(pk=self.post.pk).update(tag_count=Post.max_tags_count + 1)
+
+    def test_tag_count(self):
+        tags = [Tag.objects.create(name=f'tag{i}') for i in range(3)]
+        self.post.tags.add(*tags[:2])
+        tags[2].posts.add(self.post)
+        self.post.tags.remove(tags[0])
+        tags[1].delete()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.tag_count, 1)
+
+        self.post.tags.clear()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.tag_count, 0)
+
+    def test_legacy_post_without_counters(self):
+        tag = Tag.objects.create(name='legacy')
+        self.post.tags.add(tag)
+        Images.objects.create(post=self.post, image='sample')
+        Post.objects.filter(pk=self.post.pk).update(image_count=0, tag_count=0)
+
+        self.post.tags.remove(tag)
+        self.post.images.get().delete()
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.image_count, self.post.tag_count), (0, 0))
+
+
+class TestPostCardVersion(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user(email='tests@tests.tests')
+        Post.objects.create(user=user)
+
+    def setUp(self):
+        self.user = CustomUser.objects.get(email='tests@tests.tests')
+        self.post = Post.objects.get(user=self.user)
+
+    def assertVersionBumped(self, post=None):
+        post = post or self.post
+        version = post.card_version
+        post.refresh_from_db()
+        self.assertGreater(post.card_version, version)
+
+    def test_vote(self):
+        self.post.update_vote_counters(likes=1)
+        self.assertVersionBumped()
+
+    def test_tag_add(self):
+        self.post.tags.add(Tag.objects.create(name='tag'))
+        self.assertVersionBumped()
+
+    def test_tag_reverse_add(self):
+        Tag.objects.create(name='tag').posts.add(self.post)
+        self.assertVersionBumped()
+
+    def test_tag_remove(self):
+        tag = Tag.objects.create(name='tag')
+        self.post.tags.add(tag)
+        self.post.refresh_from_db()
+        self.post.tags.remove(tag)
+        self.assertVersionBumped()
+
+    def test_image_delete(self):
+        Images.objects.create(post=self.post, image='sample')
+        self.post.refresh_from_db()
+        self.post.images.first().delete()
+        self.assertVersionBumped()
+
+    def test_author_profile_change(self):
+        self.user.first_name = 'John'
+        self.user.save(update_fields=['first_name'])
+        self.assertVersionBumped()
+
+    def test_author_unrelated_change(self):
+        self.user.save(update_fields=['last_login'])
+        version = self.post.card_version
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.card_version, version)
+
 
 class TestFollow(TestCase):
     def test_user(self):
@@ -308,3 +753,241 @@ class TestFollow(TestCase):
     def test_meta_unique_together(self):
         unique_together = Follow._meta.unique_together[0]
         self.assertEqual(unique_together, ('user', 'followed_id'))
+
+
+class TestFollowManager(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(3):
+            CustomUser.objects.create_user(email=f'user{i}@foo.foo')
+
+    def setUp(self):
+        self.user, self.author, self.other = CustomUser.objects.order_by('id')
+
+    def assertCounts(self, user, follow_count, followed_count):
+        user.refresh_from_db()
+        self.assertEqual((user.follow_count, user.get_followed_count()), (follow_count, followed_count))
+
+    def test_follow(self):
+        self.assertTrue(Follow.objects.follow(self.user, self.author))
+        self.assertFalse(Follow.objects.follow(self.user, self.author))
+
+        self.assertCounts(self.user, 1, 0)
+        self.assertCounts(self.author, 0, 1)
+
+    def test_unfollow(self):
+        Follow.objects.follow(self.user, self.author)
+
+        self.assertTrue(Follow.objects.unfollow(self.user, self.author))
+        self.assertFalse(Follow.objects.unfollow(self.user, self.author))
+        self.assertCounts(self.user, 0, 0)
+        self.assertCounts(self.author, 0, 0)
+
+    def test_counters_are_not_read(self):
+        Follow.objects.follow(self.user, self.author)
+        stale_author = CustomUser.objects.get(pk=self.author.pk)
+        stale_author.followed_count = 0  # another request has read the counter before this follow
+        Follow.objects.follow(self.other, stale_author)
+
+        self.assertCounts(self.author, 0, 2)
+
+    def test_get_followed_ids(self):
+        Follow.objects.follow(self.user, self.author)
+        Follow.objects.follow(self.author, self.other)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Follow.objects.get_followed_ids(self.user, [self.author, self.other]), {self.author.pk})
+        with self.assertNumQueries(0):
+            self.assertEqual(Follow.objects.get_followed_ids(self.user, []), set())
+
+    @patch.object(settings, 'FOLLOWER_COUNT_SHARDS', 4)
+    @patch.object(TimelineEntry, 'fan_out_followers_threshold', -1)  # every account is hot
+    def test_sharded_follower_count(self):
+        Follow.objects.follow(self.user, self.author)
+        Follow.objects.follow(self.other, self.author)
+        Follow.objects.unfollow(self.user, self.author)
+
+        self.assertCounts(self.author, 0, 1)
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.followed_count, 0)
+        self.assertEqual(self.author.follower_count_shards.aggregate(models.Sum('count'))['count__sum'], 1)
+
+
+class TestTimelineEntry(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = CustomUser.objects.create_user(email='author@foo.foo')
+        for i in range(3):
+            follower = CustomUser.objects.create_user(email=f'follower{i}@foo.foo')
+            Follow.objects.create(user=follower, followed_id=author)
+        CustomUser.objects.create_user(email='stranger@foo.foo')
+
+    def setUp(self):
+        self.author = CustomUser.objects.get(email='author@foo.foo')
+        self.follower = CustomUser.objects.get(email='follower0@foo.foo')
+        self.stranger = CustomUser.objects.get(email='stranger@foo.foo')
+
+    def test_fan_out(self):
+        post = Post.objects.create(user=self.author)
+        TimelineEntry.objects.fan_out(post)
+
+        user_ids = set(TimelineEntry.objects.filter(post=post).values_list('user_id', flat=True))
+        expected_ids = set(Follow.objects.filter(followed_id=self.author).values_list('user_id', flat=True))
+        expected_ids.add(self.author.id)
+        self.assertEqual(user_ids, expected_ids)
+
+    def test_fan_out_in_batches(self):
+        post = Post.objects.create(user=self.author)
+        with patch.object(TimelineEntryManager, 'fan_out_batch_size', 2):
+            TimelineEntry.objects.fan_out(post)
+
+        self.assertEqual(TimelineEntry.objects.filter(post=post).count(), 4)
+
+    def test_backfill(self):
+        posts = [Post.objects.create(user=self.author) for _ in range(3)]
+        Post.objects.create(user=self.follower)
+        TimelineEntry.objects.backfill(user=self.stranger, author=self.author)
+
+        post_ids = set(self.stranger.timeline.values_list('post_id', flat=True))
+        self.assertEqual(post_ids, {post.id for post in posts})
+
+    def test_prune(self):
+        own_post = Post.objects.create(user=self.stranger)
+        TimelineEntry.objects.create(user=self.stranger, post=own_post)
+        Post.objects.create(user=self.author)
+        TimelineEntry.objects.backfill(user=self.stranger, author=self.author)
+        TimelineEntry.objects.prune(user=self.stranger, author=self.author)
+
+        self.assertEqual(list(self.stranger.timeline.values_list('post_id', flat=True)), [own_post.id])
+
+    @patch.object(TimelineEntry, 'max_entries_per_user', 2)
+    def test_trim(self):
+        posts = [Post.objects.create(user=self.author) for _ in range(4)]
+        TimelineEntry.objects.backfill(user=self.stranger, author=self.author)
+
+        post_ids = set(self.stranger.timeline.values_list('post_id', flat=True))
+        self.assertEqual(post_ids, {posts[-1].id, posts[-2].id})
+
+    @patch.object(TimelineEntry, 'max_entries_per_user', 2)
+    def test_fan_out_trims(self):
+        posts = [Post.objects.create(user=self.author) for _ in range(3)]
+        with patch.object(TimelineEntryManager, 'fan_out_batch_size', 2):
+            for post in posts:
+                TimelineEntry.objects.fan_out(post)
+
+        for user_id in Follow.objects.filter(followed_id=self.author).values_list('user_id', flat=True):
+            post_ids = set(TimelineEntry.objects.filter(user_id=user_id).values_list('post_id', flat=True))
+            self.assertEqual(post_ids, {posts[1].id, posts[2].id})
+        self.assertEqual(self.author.timeline.count(), 2)
+
+    def test_cascade_on_post_delete(self):
+        post = Post.objects.create(user=self.author)
+        TimelineEntry.objects.fan_out(post)
+        post.delete()
+
+        self.assertFalse(TimelineEntry.objects.exists())
+
+    def test_meta_unique_together(self):
+        unique_together = TimelineEntry._meta.unique_together[0]
+        self.assertEqual(unique_together, ('user', 'post'))
+
+
+class TestHybridTimeline(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        celebrity = CustomUser.objects.create_user(email='celebrity@foo.foo', followed_count=2)
+        author = CustomUser.objects.create_user(email='author@foo.foo', followed_count=1)
+        reader = CustomUser.objects.create_user(email='reader@foo.foo')
+        fan = CustomUser.objects.create_user(email='fan@foo.foo')
+        Follow.objects.create(user=reader, followed_id=celebrity)
+        Follow.objects.create(user=fan, followed_id=celebrity)
+        Follow.objects.create(user=reader, followed_id=author)
+
+    def setUp(self):
+        cache.clear()
+        self.celebrity = CustomUser.objects.get(email='celebrity@foo.foo')
+        self.author = CustomUser.objects.get(email='author@foo.foo')
+        self.reader = CustomUser.objects.get(email='reader@foo.foo')
+        patcher = patch.object(TimelineEntry, 'fan_out_followers_threshold', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create_posts(self, *authors):
+        posts = []
+        for author in authors:
+            post = Post.objects.create(user=author)
+            TimelineEntry.objects.fan_out(post)
+            posts.append(post)
+        return posts
+
+    def test_celebrity_post_is_not_fanned_out(self):
+        post, = self._create_posts(self.celebrity)
+        user_ids = list(TimelineEntry.objects.filter(post=post).values_list('user_id', flat=True))
+        self.assertEqual(user_ids, [self.celebrity.id])
+
+    def test_celebrity_is_not_backfilled(self):
+        self._create_posts(self.celebrity)
+        TimelineEntry.objects.backfill(user=self.reader, author=self.celebrity)
+        self.assertFalse(self.reader.timeline.exists())
+
+    def test_merge(self):
+        posts = self._create_posts(self.author, self.celebrity, self.author, self.celebrity, self.author)
+        post_ids = TimelineEntry.objects.get_page_post_ids(self.reader, limit=10)
+        self.assertEqual(post_ids, [post.id for post in reversed(posts)])
+
+    def test_merge_with_cursor(self):
+        posts = self._create_posts(self.author, self.celebrity, self.author, self.celebrity, self.author)
+        ids = [post.id for post in posts]
+
+        self.assertEqual(TimelineEntry.objects.get_page_post_ids(self.reader, limit=2, before=ids[3]),
+                         [ids[2], ids[1]])
+        self.assertEqual(TimelineEntry.objects.get_page_post_ids(self.reader, limit=2, after=ids[1]),
+                         [ids[2], ids[3]])
+
+    def test_merge_skips_duplicates(self):
+        post, = self._create_posts(self.celebrity)
+        TimelineEntry.objects.create(user=self.reader, post=post)  # fanned out before becoming a celebrity
+
+        post_ids = TimelineEntry.objects.get_page_post_ids(self.reader, limit=10)
+        self.assertEqual(post_ids, [post.id])
+
+    def test_author_posts_are_cached(self):
+        self._create_posts(self.celebrity)
+        TimelineEntry.objects.get_author_post_ids([self.celebrity.id])
+
+        with self.assertNumQueries(0):
+            TimelineEntry.objects.get_author_post_ids([self.celebrity.id])
+
+    def test_author_posts_cache_timeout(self):
+        self.assertEqual(TimelineEntry.objects.get_author_posts_cache_timeout(),
+                         TimelineEntryManager.author_posts_local_cache_timeout)
+
+        redis = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                             'LOCATION': 'redis://localhost:6379/0'}}
+        with override_settings(CACHES=redis):
+            self.assertEqual(TimelineEntry.objects.get_author_posts_cache_timeout(),
+                             TimelineEntryManager.author_posts_cache_timeout)
+
+    def test_new_celebrity_post_invalidates_cache(self):
+        TimelineEntry.objects.get_author_post_ids([self.celebrity.id])
+        post, = self._create_posts(self.celebrity)
+
+        post_ids = TimelineEntry.objects.get_author_post_ids([self.celebrity.id])
+        self.assertEqual(post_ids, {self.celebrity.id: [post.id]})
+
+    def test_deleted_celebrity_post_invalidates_cache(self):
+        posts = self._create_posts(self.celebrity, self.celebrity)
+        TimelineEntry.objects.get_author_post_ids([self.celebrity.id])
+        posts[1].delete()
+
+        post_ids = TimelineEntry.objects.get_author_post_ids([self.celebrity.id])
+        self.assertEqual(post_ids, {self.celebrity.id: [posts[0].id]})
+
+    def test_page_is_filled_past_stale_cached_ids(self):
+        posts = self._create_posts(*[self.celebrity, self.author] * 3)
+        TimelineEntry.objects.get_author_post_ids([self.celebrity.id])
+        with patch('dj_gram.models.cache.delete'):  # the cache stays stale
+            posts[4].delete()
+
+        post_ids = TimelineEntry.objects.get_page_post_ids(self.reader, limit=3)
+        self.assertEqual(post_ids, [posts[5].id, posts[3].id, posts[2].id])
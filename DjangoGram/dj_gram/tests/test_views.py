@@ -1,10 +1,14 @@
+import tempfile
 from unittest.mock import patch
 
 from django.contrib.sites.shortcuts import get_current_site
 from django.core import mail
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.template.loader import render_to_string
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils.encoding import force_bytes
 from django.utils.html import strip_tags
@@ -13,9 +17,10 @@ from django.utils.http import urlsafe_base64_encode
 from dj_gram.forms import TagForm, CustomUserCreationForm, CustomUserFillForm
 from dj_gram.models import *
 from .conf import create_test_image
+from dj_gram.page_cache import get_page_cache_key, invalidate_page
 from dj_gram.tokens import account_activation_token
-from dj_gram.views import AddTag, Feed, Registration, FillProfile, ViewPost, Voting, Subscribe, AddPost,\
-    LoginRequiredMixin, PostContextMixin, HeaderContextMixin
+from dj_gram.views import AddTag, Feed, FollowingFeed, Registration, FillProfile, ViewPost, Voting, Subscribe, AddPost,\
+    ProfilePage, LoginRequiredMixin, PostContextMixin, HeaderContextMixin, FollowersList
 
 
 class TestViewPost(TestCase):
@@ -120,6 +125,7 @@ class TestAddTag(TestCase):
         self.assertEqual(self.post.tags.count(), 0)
 
 
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
 class TestAddPost(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -173,6 +179,30 @@ class TestAddPost(TestCase):
         image = Images.objects.first()
         self.assertEqual(post.tags.count(), 2)
         self.assertEqual(image.post, post)
+        self.assertEqual((post.tag_count, post.image_count), (2, 1))
+
+    def test_failed_post_creation_leaves_nothing(self):
+        self.client.force_login(user=self.user)
+        files = {'image': [create_test_image().open(), create_test_image().open()]}
+        storage = Images.raw_image.field.storage
+        raw_images = storage.listdir('raw_images')[1] if storage.exists('raw_images') else []
+        with patch.object(TimelineEntryManager, 'fan_out', side_effect=Exception('Connection lost')):
+            with self.assertRaises(Exception):
+                self.client.post(reverse('dj_gram:add_post'), {'name': '#two #tags', **files})
+
+        self.assertFalse(Post.objects.exists())
+        self.assertFalse(Images.objects.exists())
+        self.assertFalse(Tag.objects.filter(posts__isnull=False).exists())
+        self.assertEqual(storage.listdir('raw_images')[1], raw_images)
+
+    def test_too_many_tags(self):
+        self.client.force_login(user=self.user)
+        tags = ' '.join(f'#tag{i}' for i in range(Post.max_tags_count + 1))
+        response = self.client.post(reverse('dj_gram:add_post'), {'name': tags, 'image': create_test_image().open()})
+
+        self.assertFormError(response.context['multiple_tags_form'], 'name',
+                             f'Post can have up to {Post.max_tags_count} tags.')
+        self.assertFalse(Post.objects.exists())
 
 
 class TestFeed(TestCase):
@@ -203,6 +233,386 @@ class TestFeed(TestCase):
         self.assertEqual(paginate_by, 3)
 
 
+class TestPostContextMixin(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user(email='foo@foo.foo', is_active=True)
+        for _ in range(10):
+            Post.objects.create(user=user)
+
+    def setUp(self):
+        self.user = CustomUser.objects.get(email='foo@foo.foo')
+        self.mixin = PostContextMixin()
+        self.mixin.request = RequestFactory().get(reverse('dj_gram:feed'))
+        self.mixin.request.user = self.user
+
+    def test_voting_context(self):
+        liked_post, disliked_post = Post.objects.all()[:2]
+        Vote.objects.create(user=self.user, post=liked_post, vote=True)
+        Vote.objects.create(user=self.user, post=disliked_post, vote=False)
+
+        context = self.mixin._get_voting_context(posts=Post.objects.all())
+        self.assertEqual(context['votes'], {liked_post.id: True, disliked_post.id: False})
+
+    def test_voting_context_query_budget(self):
+        """Votes of the whole page are loaded by one query regardless of the page size"""
+
+        for post in Post.objects.all():
+            Vote.objects.create(user=self.user, post=post, vote=True)
+
+        for page_size in (1, 3, 10):
+            posts = list(Post.objects.all()[:page_size])
+            with self.subTest(page_size=page_size), self.assertNumQueries(1):
+                self.mixin._get_voting_context(posts=posts)
+
+
+class TestPostCardQueries(TestCase):
+    """Rendering a page of post cards must cost the same number of queries for any page size"""
+
+    @classmethod
+    def setUpTestData(cls):
+        CustomUser.objects.create_user(email='foo@foo.foo', first_name='John', last_name='Doe', is_active=True)
+
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.get(email='foo@foo.foo')
+        self.client.force_login(user=self.user)
+
+    def _create_posts(self, count):
+        tags = [Tag.objects.get_or_create(name=f'tag{i}')[0] for i in range(2)]
+        for _ in range(count):
+            post = Post.objects.create(user=self.user)
+            post.tags.add(*tags)
+            # bulk_create skips Images.save(), so no upload to the cloud is made
+            Images.objects.bulk_create([Images(post=post, image='sample') for _ in range(2)])
+            Vote.objects.create(user=self.user, post=post, vote=True)
+
+    def _count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_for_cards_prefetch(self):
+        self._create_posts(3)
+        posts = list(Post.objects.for_cards())
+
+        with self.assertNumQueries(0):
+            for post in posts:
+                post.user.avatar, list(post.images.all()), list(post.tags.all())
+
+    def test_feed(self):
+        url = reverse('dj_gram:feed')
+        self._create_posts(1)
+        one_post_queries = self._count_queries(url)
+        self._create_posts(Feed.paginate_by)
+        full_page_queries = self._count_queries(url)
+
+        self.assertEqual(one_post_queries, full_page_queries)
+
+    def test_profile_page(self):
+        url = reverse('dj_gram:profile', kwargs={'pk': self.user.id})
+        self._create_posts(1)
+        one_post_queries = self._count_queries(url)
+        self._create_posts(ProfilePage.paginate_by)
+        full_page_queries = self._count_queries(url)
+
+        self.assertEqual(one_post_queries, full_page_queries)
+
+    def test_view_post(self):
+        self._create_posts(1)
+        post = Post.objects.first()
+        url = reverse('dj_gram:view_post', kwargs={'pk': post.id})
+        queries = self._count_queries(url)
+
+        Images.objects.bulk_create([Images(post=post, image='sample') for _ in range(5)])
+        post.tags.add(*[Tag.objects.create(name=f'new{i}') for i in range(3)])
+        self.assertEqual(queries, self._count_queries(url))
+
+
+class TestCursorPagination(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user(email='foo@foo.foo', is_active=True)
+        for _ in range(3 * Feed.paginate_by + 1):
+            Post.objects.create(user=user)
+
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.get(email='foo@foo.foo')
+        self.post_ids = list(Post.objects.values_list('id', flat=True))
+
+    def _get_page(self, cursor=None):
+        data = {'cursor': cursor} if cursor else {}
+        response = self.client.get(reverse('dj_gram:feed'), data)
+        self.assertEqual(response.status_code, 200)
+        return response.context['page_obj']
+
+    def _ids(self, page):
+        return [post.id for post in page.object_list]
+
+    def test_first_page(self):
+        page = self._get_page()
+
+        self.assertEqual(self._ids(page), self.post_ids[:3])
+        self.assertTrue(page.has_next())
+        self.assertFalse(page.has_previous())
+
+    def test_next_and_previous_pages(self):
+        first_page = self._get_page()
+        second_page = self._get_page(first_page.next_cursor)
+        self.assertEqual(self._ids(second_page), self.post_ids[3:6])
+        self.assertTrue(second_page.has_previous())
+
+        third_page = self._get_page(second_page.next_cursor)
+        self.assertEqual(self._ids(third_page), self.post_ids[6:9])
+
+        back_page = self._get_page(third_page.previous_cursor)
+        self.assertEqual(self._ids(back_page), self.post_ids[3:6])
+        self.assertTrue(back_page.has_next())
+
+        first_page = self._get_page(back_page.previous_cursor)
+        self.assertEqual(self._ids(first_page), self.post_ids[:3])
+        self.assertFalse(first_page.has_previous())
+
+    def test_last_page(self):
+        page = self._get_page(self._get_page().last_cursor)
+
+        self.assertEqual(self._ids(page), self.post_ids[-3:])
+        self.assertFalse(page.has_next())
+        self.assertTrue(page.has_previous())
+
+    def test_invalid_cursor(self):
+        for cursor in ('wrong', urlsafe_base64_encode(force_bytes('x:1')), urlsafe_base64_encode(force_bytes('n:a'))):
+            with self.subTest(cursor=cursor):
+                response = self.client.get(reverse('dj_gram:feed'), {'cursor': cursor})
+                self.assertEqual(response.status_code, 404)
+
+    def test_deep_page_costs_same_as_first(self):
+        with CaptureQueriesContext(connection) as first_page_queries:
+            page = self._get_page()
+        with CaptureQueriesContext(connection) as deep_page_queries:
+            self._get_page(self._get_page(page.next_cursor).next_cursor)
+
+        self.assertEqual(len(first_page_queries) * 2, len(deep_page_queries))
+        for query in first_page_queries.captured_queries + deep_page_queries.captured_queries:
+            with self.subTest(sql=query['sql']):
+                self.assertNotIn('COUNT(', query['sql'].upper())
+                self.assertNotIn('OFFSET', query['sql'].upper())
+
+    def test_profile_page(self):
+        self.client.force_login(user=self.user)
+        url = reverse('dj_gram:profile', kwargs={'pk': self.user.id})
+        page = self.client.get(url).context['page_obj']
+        next_page = self.client.get(url, {'cursor': page.next_cursor}).context['page_obj']
+
+        page_size = ProfilePage.paginate_by
+        self.assertEqual(self._ids(next_page), self.post_ids[page_size:2 * page_size])
+
+
+class TestFollowingFeed(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user(email='foo@foo.foo', is_active=True)
+        author = CustomUser.objects.create_user(email='bar@bar.bar', is_active=True)
+        stranger = CustomUser.objects.create_user(email='baz@baz.baz', is_active=True)
+        Follow.objects.create(user=user, followed_id=author)
+
+        for post in (Post.objects.create(user=author), Post.objects.create(user=stranger)):
+            TimelineEntry.objects.fan_out(post)
+
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.get(email='foo@foo.foo')
+        self.author = CustomUser.objects.get(email='bar@bar.bar')
+
+    def test_mixins_is_present(self):
+        self.assertTrue(LoginRequiredMixin in FollowingFeed.__bases__)
+        self.assertTrue(issubclass(FollowingFeed, Feed))
+
+    def test_anonymous_user(self):
+        response = self.client.get(reverse('dj_gram:following_feed'))
+        self.assertRedirects(response, reverse('authentication:login_user') + '?next=/feed/following/')
+
+    def test_posts_of_followed_authors(self):
+        self.client.force_login(user=self.user)
+        response = self.client.get(reverse('dj_gram:following_feed'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'dj_gram/feed.html')
+        self.assertEqual([post.user for post in response.context['posts']], [self.author])
+        self.assertEqual(response.context['selected_nav_elem'], 'FOLLOWING')
+
+    def test_add_post_fans_out(self):
+        self.client.force_login(user=self.author)
+        with patch('dj_gram.forms.ImageForm.save'):
+            self.client.post(reverse('dj_gram:add_post'), {'image': create_test_image().open()})
+
+        post = Post.objects.first()
+        self.assertTrue(TimelineEntry.objects.filter(user=self.user, post=post).exists())
+
+    @patch.object(TimelineEntry, 'fan_out_followers_threshold', 0)
+    def test_posts_of_not_fanned_out_authors(self):
+        post = Post.objects.create(user=self.author)
+        TimelineEntry.objects.fan_out(post)
+
+        self.client.force_login(user=self.user)
+        response = self.client.get(reverse('dj_gram:following_feed'))
+        self.assertEqual(response.context['posts'][0], post)
+
+    def test_subscribe_backfills_and_unsubscribe_prunes(self):
+        stranger = CustomUser.objects.get(email='baz@baz.baz')
+        self.client.force_login(user=self.user)
+        url_kwargs = {'followed_user_id': stranger.id, 'action': 'subscribe'}
+        self.client.get(reverse('dj_gram:subscribe', kwargs=url_kwargs), HTTP_REFERER=reverse('dj_gram:feed'))
+        self.assertTrue(self.user.timeline.filter(post__user=stranger).exists())
+
+        url_kwargs['action'] = 'unsubscribe'
+        self.client.get(reverse('dj_gram:subscribe', kwargs=url_kwargs), HTTP_REFERER=reverse('dj_gram:feed'))
+        self.assertFalse(self.user.timeline.filter(post__user=stranger).exists())
+
+
+class TestPostCardCache(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user(email='foo@foo.foo', is_active=True)
+        CustomUser.objects.create_user(email='bar@bar.bar', is_active=True)
+        Post.objects.create(user=user)
+
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.get(email='foo@foo.foo')
+        self.other_user = CustomUser.objects.get(email='bar@bar.bar')
+        self.post = Post.objects.get(user=self.user)
+
+    def _get_feed(self):
+        return self.client.get(reverse('dj_gram:feed')).content.decode()
+
+    def test_card_is_cached(self):
+        self.client.force_login(user=self.other_user)  # anonymous Feed page is cached as a whole
+        self._get_feed()
+        Post.objects.filter(pk=self.post.pk).update(like_count=42)
+        self.assertNotIn('<span class="like-count">42</span>', self._get_feed())
+
+        Post.objects.filter(pk=self.post.pk).invalidate_cards()
+        self.assertIn('<span class="like-count">42</span>', self._get_feed())
+
+    def test_vote_invalidates_card(self):
+        self._get_feed()
+        self.client.force_login(user=self.other_user)
+        self.client.post(reverse('dj_gram:vote', kwargs={'post_id': self.post.id, 'vote': 1}),
+                         HTTP_REFERER=reverse('dj_gram:feed'))
+
+        self.assertIn('class="btn btn-outline-success py-0 vote-like">Like</button>', self._get_feed())
+        self.assertIn('<span class="like-count">1</span>', self._get_feed())
+
+    def test_card_is_shared_by_viewers(self):
+        Vote.objects.create(user=self.other_user, post=self.post, vote=False)
+
+        self.client.force_login(user=self.other_user)
+        response = self.client.get(reverse('dj_gram:feed'))
+        self.assertContains(response, 'post-voted-dislike')
+
+        self.client.force_login(user=self.user)
+        response = self.client.get(reverse('dj_gram:feed'))
+        self.assertNotContains(response, 'post-voted-dislike')
+
+    def test_responsive_image(self):
+        Images.objects.bulk_create([Images(post=self.post, image='ab/cd/abcd.jpg', width=960, height=720)])
+        response = self.client.get(reverse('dj_gram:feed'))
+
+        self.assertContains(response, '<source type="image/webp"')
+        self.assertContains(response, '/images/ab/cd/abcd_crop-limit_width-320.webp 320w')
+        self.assertContains(response, '/images/ab/cd/abcd_crop-limit_width-1280.jpg 960w')
+
+    def test_processing_image_placeholder(self):
+        Images.objects.bulk_create([Images(post=self.post, status=Images.PROCESSING)])
+        response = self.client.get(reverse('dj_gram:feed'))
+
+        self.assertContains(response, 'Image is being processed')
+        self.assertNotContains(response, '<img class="mx-auto')
+
+    def test_owner_controls_are_not_cached(self):
+        self.client.force_login(user=self.other_user)
+        self.assertNotContains(self.client.get(reverse('dj_gram:feed')), 'Delete post')
+
+        self.client.force_login(user=self.user)
+        self.assertContains(self.client.get(reverse('dj_gram:feed')), 'Delete post')
+
+
+class TestAnonymousPageCache(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user(email='foo@foo.foo', is_active=True)
+        for _ in range(Feed.paginate_by + 1):
+            Post.objects.create(user=user)
+
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.get(email='foo@foo.foo')
+        self.url = reverse('dj_gram:feed')
+        self.page_key = get_page_cache_key(self.url)
+
+    def test_page_is_cached(self):
+        response = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            cached_response = self.client.get(self.url)
+
+        self.assertEqual(cached_response.status_code, 200)
+        self.assertEqual(cached_response.content, response.content)
+
+    def test_authenticated_user_is_not_cached(self):
+        self.client.get(self.url)
+        self.client.force_login(user=self.user)
+
+        response = self.client.get(self.url)
+        self.assertIn('posts', response.context)
+        self.assertContains(response, 'LOGOUT')
+
+    def test_stale_page_is_served_while_locked(self):
+        self.client.get(self.url)
+        cache.delete(self.page_key + ':fresh')
+        cache.add(self.page_key + ':lock', True)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_stale_page_is_regenerated(self):
+        self.client.get(self.url)
+        Post.objects.create(user=self.user)
+        invalidate_page(self.url)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['posts'][0], Post.objects.first())
+        self.assertIn(self.page_key + ':fresh', cache)
+        self.assertNotIn(self.page_key + ':lock', cache)
+
+    def test_vote_invalidates_page(self):
+        post = Post.objects.first()
+        self.client.get(self.url)
+        self.client.force_login(user=self.user)
+        self.client.post(reverse('dj_gram:vote', kwargs={'post_id': post.id, 'vote': 1}), HTTP_REFERER=self.url)
+
+        self.assertNotIn(self.page_key + ':fresh', cache)
+
+    def test_vote_on_other_page_keeps_page_fresh(self):
+        post = Post.objects.last()
+        self.client.get(self.url)
+        self.client.force_login(user=self.user)
+        self.client.post(reverse('dj_gram:vote', kwargs={'post_id': post.id, 'vote': 1}), HTTP_REFERER=self.url)
+
+        self.assertIn(self.page_key + ':fresh', cache)
+
+    def test_new_post_invalidates_first_page(self):
+        self.client.get(self.url)
+        self.client.force_login(user=self.user)
+        with patch('dj_gram.forms.ImageForm.save'):
+            self.client.post(reverse('dj_gram:add_post'), {'image': create_test_image().open()})
+
+        self.assertNotIn(self.page_key + ':fresh', cache)
+
+
 class TestVote(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -228,47 +638,92 @@ class TestVote(TestCase):
     def test_create_vote_like(self):
         self.client.force_login(self.user)
 
-        response = self.client.get(reverse('dj_gram:vote', kwargs={'post_id': self.post.id, 'vote': 1}),
-                                   HTTP_REFERER=reverse('dj_gram:feed'))
+        response = self.client.post(reverse('dj_gram:vote', kwargs={'post_id': self.post.id, 'vote': 1}),
+                                    HTTP_REFERER=reverse('dj_gram:feed'))
         self.assertEqual(response.status_code, 302)
         self.assertRedirects(response, reverse('dj_gram:feed'))
 
         vote = Vote.objects.get(post=self.post, user=self.user)
         self.assertTrue(vote.vote)
 
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.like_count, self.post.dislike_count), (1, 0))
+
     def test_create_vote_dislike(self):
         self.client.force_login(self.user)
 
-        response = self.client.get(reverse('dj_gram:vote', kwargs={'post_id': self.post.id, 'vote': 0}),
-                                   HTTP_REFERER=reverse('dj_gram:feed'))
+        response = self.client.post(reverse('dj_gram:vote', kwargs={'post_id': self.post.id, 'vote': 0}),
+                                    HTTP_REFERER=reverse('dj_gram:feed'))
         self.assertEqual(response.status_code, 302)
         self.assertRedirects(response, reverse('dj_gram:feed'))
 
         vote = Vote.objects.get(post=self.post, user=self.user)
         self.assertFalse(vote.vote)
 
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.like_count, self.post.dislike_count), (0, 1))
+
     def test_change_vote(self):
         Vote.objects.create(user=self.user, post=self.post, vote=True)
+        self.post.update_vote_counters(likes=1)
         self.client.force_login(self.user)
 
-        response = self.client.get(reverse('dj_gram:vote', kwargs={'post_id': self.post.id, 'vote': 0}),
-                                   HTTP_REFERER=reverse('dj_gram:feed'))
+        response = self.client.post(reverse('dj_gram:vote', kwargs={'post_id': self.post.id, 'vote': 0}),
+                                    HTTP_REFERER=reverse('dj_gram:feed'))
         self.assertEqual(response.status_code, 302)
         self.assertRedirects(response, reverse('dj_gram:feed'))
         vote = Vote.objects.get(user=self.user, post=self.post)
         self.assertFalse(vote.vote)
 
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.like_count, self.post.dislike_count), (0, 1))
+
     def test_delete_vote(self):
         Vote.objects.create(user=self.user, post=self.post, vote=True)
+        self.post.update_vote_counters(likes=1)
         self.client.force_login(self.user)
 
-        response = self.client.get(reverse('dj_gram:vote', kwargs={'post_id': self.post.id, 'vote': 1}),
-                                   HTTP_REFERER=reverse('dj_gram:feed'))
+        response = self.client.post(reverse('dj_gram:vote', kwargs={'post_id': self.post.id, 'vote': 1}),
+                                    HTTP_REFERER=reverse('dj_gram:feed'))
         self.assertEqual(response.status_code, 302)
         self.assertRedirects(response, reverse('dj_gram:feed'))
         with self.assertRaises(ObjectDoesNotExist):
             Vote.objects.get(user=self.user, post=self.post)
 
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.like_count, self.post.dislike_count), (0, 0))
+
+    def test_post_returns_counters(self):
+        self.client.force_login(self.user)
+        url = reverse('dj_gram:vote', kwargs={'post_id': self.post.id, 'vote': 1})
+
+        response = self.client.post(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json(), {'like_count': 1, 'dislike_count': 0, 'vote': True})
+        response = self.client.post(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json(), {'like_count': 0, 'dislike_count': 0, 'vote': None})
+        self.assertFalse(Vote.objects.exists())
+
+    def test_get_does_not_vote(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('dj_gram:vote', kwargs={'post_id': self.post.id, 'vote': 1}))
+
+        self.assertRedirects(response, reverse('dj_gram:view_post', kwargs={'pk': self.post.id}))
+        self.assertFalse(Vote.objects.exists())
+
+    def test_vote_form_is_outside_of_shared_card(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('dj_gram:feed'))
+
+        self.assertContains(response, f'form="vote-form-{self.post.id}"', count=2)
+        self.assertInHTML(f'<form id="vote-form-{self.post.id}" method="post" class="d-none">'
+                          f'<input type="hidden" name="csrfmiddlewaretoken" '
+                          f'value="{response.context["csrf_token"]}"></form>', response.content.decode())
+
+    def test_post_missing_post(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('dj_gram:vote', kwargs={'post_id': 1000, 'vote': 1}))
+        self.assertEqual(response.status_code, 404)
+
 
 class TestRegistration(TestCase):
     def test_mixins_is_present(self):
@@ -399,6 +854,26 @@ class TestFillProfile(TestCase):
         self.assertEqual(user.first_name, data['first_name'])  # check if instance=user in get_form()
 
 
+class TestEditProfilePage(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CustomUser.objects.create_user(email='foo@foo.foo', first_name='John', last_name='Doe', is_active=True)
+
+    def setUp(self):
+        self.user = CustomUser.objects.get(email='foo@foo.foo')
+        self.client.force_login(self.user)
+
+    def test_invalid_form_with_avatar_upload(self):
+        avatar = create_test_image()
+        avatar.seek(0)
+        response = self.client.post(reverse('dj_gram:edit_profile', kwargs={'pk': self.user.pk}),
+                                    {'first_name': 'J' * 40, 'last_name': 'Doe', 'bio': '', 'avatar': avatar})
+
+        self.assertEqual(response.status_code, 200)  # the form is rendered again instead of redirecting
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.avatar)
+
+
 class TestSubscribe(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -442,3 +917,102 @@ class TestSubscribe(TestCase):
         self.user_2 = CustomUser.objects.get(email='bar@bar.bar')
         self.assertEqual(self.user_1.follow_count, 0)
         self.assertEqual(self.user_2.followed_count, 0)
+
+
+class TestDeleteAccount(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CustomUser.objects.create_user(email='foo@foo.foo', is_active=True)
+
+    def setUp(self):
+        self.user = CustomUser.objects.get(email='foo@foo.foo')
+        self.client.force_login(user=self.user)
+
+    def test_get(self):
+        response = self.client.get(reverse('dj_gram:delete_account'))
+        self.assertTemplateUsed(response, 'dj_gram/account_confirm_delete.html')
+
+    def test_post(self):
+        Post.objects.create(user=self.user)
+        response = self.client.post(reverse('dj_gram:delete_account'))
+
+        self.assertRedirects(response, reverse('dj_gram:feed'))
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+        self.assertIsNotNone(self.user.deletion_requested_at)
+        self.assertTrue(self.user.posts.exists())  # content is purged in the background
+        self.assertNotIn('_auth_user_id', self.client.session)
+
+
+class TestFollowList(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = [CustomUser.objects.create_user(email=f'user{i}@foo.foo', is_active=True) for i in range(6)]
+        for user in users[1:]:
+            Follow.objects.follow(user, users[0])
+        Follow.objects.follow(users[0], users[5])
+        Follow.objects.follow(users[1], users[2])
+
+    def setUp(self):
+        self.users = list(CustomUser.objects.order_by('id'))
+        self.client.force_login(user=self.users[1])
+
+    def test_followers(self):
+        with patch.object(FollowersList, 'paginate_by', 3):
+            response = self.client.get(reverse('dj_gram:followers', kwargs={'pk': self.users[0].pk}))
+            next_page = self.client.get(reverse('dj_gram:followers', kwargs={'pk': self.users[0].pk}),
+                                        {'cursor': response.context['page_obj'].next_cursor})
+
+        self.assertEqual(response.context['listed_users'], self.users[:0:-1][:3])
+        self.assertEqual(next_page.context['listed_users'], self.users[2:0:-1])
+        self.assertEqual(response.context['followed_ids'], set())
+        self.assertEqual(next_page.context['followed_ids'], {self.users[2].pk})
+        self.assertContains(response, reverse('dj_gram:subscribe', args=[self.users[3].pk, 'subscribe']))
+        self.assertContains(next_page, reverse('dj_gram:subscribe', args=[self.users[2].pk, 'unsubscribe']))
+
+    def test_following(self):
+        response = self.client.get(reverse('dj_gram:following', kwargs={'pk': self.users[0].pk}))
+
+        self.assertEqual(response.context['listed_users'], [self.users[5]])
+        self.assertEqual(response.context['title'], 'Subscriptions')
+
+    def test_follow_state_is_one_query(self):
+        url = reverse('dj_gram:followers', kwargs={'pk': self.users[0].pk})
+        with CaptureQueriesContext(connection) as page:
+            self.client.get(url)
+        Follow.objects.follow(CustomUser.objects.create_user(email='new@foo.foo'), self.users[0])
+        Follow.objects.follow(self.users[1], self.users[3])
+
+        with self.assertNumQueries(len(page)):
+            self.client.get(url)
+
+    def test_missing_profile(self):
+        response = self.client.get(reverse('dj_gram:followers', kwargs={'pk': 1000}))
+        self.assertEqual(response.status_code, 404)
+
+
+class TestFollowSuggestions(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = [CustomUser.objects.create_user(email=f'user{i}@foo.foo', is_active=True) for i in range(4)]
+        FollowSuggestion.objects.create(user=users[0], suggested=users[1], score=1)
+        FollowSuggestion.objects.create(user=users[0], suggested=users[2], score=3)
+
+    def setUp(self):
+        self.users = list(CustomUser.objects.order_by('id'))
+        self.client.force_login(user=self.users[0])
+
+    def test_own_profile(self):
+        url = reverse('dj_gram:profile', kwargs={'pk': self.users[0].pk})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+
+        self.assertEqual([suggestion.suggested for suggestion in response.context['suggestions']],
+                         [self.users[2], self.users[1]])
+        self.assertContains(response, 'People you may know')
+        self.assertContains(response, reverse('dj_gram:subscribe', args=[self.users[2].pk, 'subscribe']))
+        self.assertEqual(len([query for query in queries if 'dj_gram_followsuggestion' in query['sql']]), 1)
+
+    def test_other_profile(self):
+        response = self.client.get(reverse('dj_gram:profile', kwargs={'pk': self.users[3].pk}))
+        self.assertNotIn('suggestions', response.context)
@@ -0,0 +1,34 @@
+from tempfile import SpooledTemporaryFile
+
+from PIL import Image, ImageOps
+
+ACCEPTABLE_IMAGE_SIZE = (1280, 720)
+
+# thumbnails bigger than Django's FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to a temp file
+THUMBNAIL_MAX_MEMORY_SIZE = 2621440
+
+
+def make_thumbnail(file, size, crop=False, image_format='jpeg', max_memory_size=THUMBNAIL_MAX_MEMORY_SIZE):
+    """
+    Downsizes the image to fit the size box and returns (file, size_in_bytes) encoded in image_format.
+    With crop the image fills the whole box and is cropped around its center instead.
+
+    JPEGs are scaled by the decoder itself (draft mode), so a full resolution bitmap
+    of a phone photo is never allocated. Other formats are reduced by an integer factor
+    before the final resampling. EXIF orientation is applied, so the thumbnail is upright.
+    """
+    with Image.open(file) as image:
+        image.draft('RGB', size)
+        image = ImageOps.exif_transpose(image)
+        if crop:
+            image = ImageOps.fit(image, size)
+        else:
+            image.thumbnail(size, reducing_gap=2.0)
+        image = image.convert('RGB')
+
+    thumbnail = SpooledTemporaryFile(max_size=max_memory_size)
+    image.save(thumbnail, image_format)
+    thumbnail_size = thumbnail.tell()
+    thumbnail.seek(0)
+
+    return thumbnail, thumbnail_size
@@ -10,13 +10,18 @@ urlpatterns = [
     path('confirm_email/<uidb64>/<umailb64>/<token>/', views.FillProfile.as_view(), name='fill_profile'),
     path('user/<int:pk>', views.ProfilePage.as_view(), name='profile'),
     path('user/<int:pk>/edit', views.EditProfilePage.as_view(), name='edit_profile'),
+    path('user/delete', views.DeleteAccount.as_view(), name='delete_account'),
+    path('user/<int:pk>/followers', views.FollowersList.as_view(), name='followers'),
+    path('user/<int:pk>/following', views.FollowingList.as_view(), name='following'),
     path('user/<int:followed_user_id>/<str:action>', views.Subscribe.as_view(), name='subscribe'),
     path('add_post/', views.AddPost.as_view(), name='add_post'),
     path('feed/', views.Feed.as_view(), name='feed'),
+    path('feed/following/', views.FollowingFeed.as_view(), name='following_feed'),
     path('post/<int:pk>', views.ViewPost.as_view(), name='view_post'),
     path('post/<int:pk>/delete', views.DeletePost.as_view(), name='delete_post'),
     path('post/<int:post_id>/add_tag', views.AddTag.as_view(), name='add_tag'),
     path('post/<int:post_id>/vote/<int:vote>', views.Voting.as_view(), name='vote'),
+    re_path(r'^images/(?P<path>.+)$', views.serve_image, name='serve_image'),
     re_path(r'^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT}),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) +\
     static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
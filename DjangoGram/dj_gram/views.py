@@ -1,25 +1,29 @@
 import cloudinary
 from django.conf.global_settings import EMAIL_HOST_USER
+from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import AnonymousUser
 from django.core.exceptions import PermissionDenied
-from django.db import IntegrityError
+from django.db import transaction
 from django.template.loader import render_to_string
 from django.urls import reverse, reverse_lazy
 from django.utils.encoding import force_bytes, force_str
 from django.utils.html import strip_tags
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.views import View
-from django.views.generic import ListView, DetailView
+from django.views.generic import ListView, DetailView, TemplateView
 from django.views.generic.edit import FormView, UpdateView, DeleteView
 from django.shortcuts import redirect, get_object_or_404
-from django.http import Http404, HttpResponseRedirect
+from django.http import Http404, HttpResponseRedirect, JsonResponse
 from django.core.mail import send_mail
 from django.contrib.sites.shortcuts import get_current_site
 from django.contrib import messages
 
 from .forms import *
+from .image_storage import get_image_storage
+from .page_cache import AnonymousPageCacheMixin, invalidate_page, invalidate_post_pages
+from .pagination import CursorPage, CursorPaginationMixin
 from .tokens import account_activation_token
 
 
@@ -27,6 +31,14 @@ def index(request):
     return redirect(reverse('dj_gram:feed'), permanent=True)
 
 
+def serve_image(request, path):
+    """Images of the local image storage, Cloudinary serves its images itself"""
+    storage = get_image_storage()
+    if not hasattr(storage, 'serve'):
+        raise Http404
+    return storage.serve(request, path)
+
+
 class HeaderContextMixin:
     @staticmethod
     def get_header_context(user_id=None, selected_nav_elem=None, *args, **kwargs):
@@ -37,7 +49,8 @@ class HeaderContextMixin:
 
         if user_id is not None:
             profile_url = reverse('dj_gram:profile', kwargs={'pk': user_id})
-            extra = [{'title': 'PROFILE', 'url': profile_url},
+            extra = [{'title': 'FOLLOWING', 'url': reverse('dj_gram:following_feed')},
+                     {'title': 'PROFILE', 'url': profile_url},
                      {'title': 'LOGOUT', 'url': reverse('authentication:logout_user')}]
         else:
             extra = [{'title': 'PROFILE', 'url': reverse('authentication:login_user')},
@@ -50,11 +63,7 @@ class HeaderContextMixin:
 
 class PostContextMixin:
     def _get_voting_context(self, posts: list):
-        context = {'votes': {}}
-        for post in posts:
-            if Vote.objects.filter(post=post.id, user=self.request.user):
-                context['votes'][post.id] = Vote.objects.get(post=post.id, user=self.request.user).vote
-
+        context = {'votes': Vote.objects.get_votes_map(user=self.request.user, posts=posts)}
         return context
 
     def _get_add_tag_context(self):
@@ -107,9 +116,20 @@ class AddPost(HeaderContextMixin, LoginRequiredMixin, FormView):
             return self.form_invalid(image_form, multiple_tags_form)
 
     def form_valid(self, image_form, multiple_tags_form):
-        post = Post.objects.create(user=self.request.user)
-        multiple_tags_form.save(post=post)
-        image_form.save(post=post)
+        """Limits are checked by the forms, the post is created with its tags and images or not at all"""
+        images = []
+        try:
+            with transaction.atomic():
+                post = Post.objects.create(user=self.request.user)
+                multiple_tags_form.save(post=post)
+                images = image_form.save(post=post)
+                TimelineEntry.objects.fan_out(post)
+        except Exception:
+            for image in images:
+                image.raw_image.delete(save=False)
+            raise
+
+        invalidate_page(reverse('dj_gram:feed'))
         return HttpResponseRedirect(self.get_success_url())
 
     def form_invalid(self, image_form, multiple_tags_form):
@@ -137,6 +157,10 @@ class DeletePost(LoginRequiredMixin, DeleteView):
         else:
             return self.form_invalid(form)
 
+    def form_valid(self, form):
+        invalidate_post_pages(self.object.id)
+        return super().form_valid(form)
+
 
 class AddTag(LoginRequiredMixin, FormView):
     template_name = 'dj_gram/add_tag.html'
@@ -157,6 +181,7 @@ class AddTag(LoginRequiredMixin, FormView):
 
     def form_valid(self, form, post):
         form.save(post=post)
+        invalidate_post_pages(post.id)
         return super(AddTag, self).form_valid(form)
 
     def get_success_url(self):
@@ -242,29 +267,19 @@ class FillProfile(HeaderContextMixin, FormView):
         return reverse('authentication:login_user')
 
 
-class ProfilePage(HeaderContextMixin, PostContextMixin, LoginRequiredMixin, ListView):
+class ProfilePage(HeaderContextMixin, PostContextMixin, CursorPaginationMixin, LoginRequiredMixin, ListView):
     model = Post
     context_object_name = 'posts'
     template_name = 'dj_gram/profile_page.html'
     paginate_by = 5
 
     def get_queryset(self):
-        self.queryset = Post.objects.filter(user=CustomUser.objects.get(pk=self.kwargs['pk']))
+        self.queryset = Post.objects.for_cards().filter(user_id=self.kwargs['pk'])
         return super().get_queryset()
 
     def get_followed_context(self, showed_profile):
-        user_profile = self.request.user
-        followed_context = {}
-        if self.request.user != showed_profile:
-            try:
-                Follow.objects.get(user=user_profile, followed_id=showed_profile)
-                followed_context['is_followed'] = True
-            except Follow.DoesNotExist:
-                followed_context['is_followed'] = False
-        else:
-            followed_context['is_followed'] = False
-
-        return followed_context
+        followed_ids = Follow.objects.get_followed_ids(self.request.user, [showed_profile])
+        return {'is_followed': showed_profile.pk in followed_ids}
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -278,10 +293,50 @@ class ProfilePage(HeaderContextMixin, PostContextMixin, LoginRequiredMixin, List
         context.update(header_context)
         context.update(followed_context)
         context.update(post_context)
+        if context['profile'].pk == self.request.user.pk:
+            context['suggestions'] = FollowSuggestion.objects.for_user(self.request.user)
+
+        return context
+
+
+class FollowList(HeaderContextMixin, CursorPaginationMixin, LoginRequiredMixin, ListView):
+    """Users who follow the profile or whom it follows, paginated over Follow rows, newest first"""
+    model = Follow
+    template_name = 'dj_gram/follow_list.html'
+    paginate_by = 20
+    profile_field = None  # field of Follow which points to the profile
+    listed_user_field = None  # field of Follow which points to the listed user
+    title = None
+
+    def get_queryset(self):
+        self.queryset = Follow.objects.filter(**{self.profile_field: self.kwargs['pk']}) \
+            .select_related(self.listed_user_field)
+        return super().get_queryset()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+
+        context['profile'] = get_object_or_404(CustomUser, pk=self.kwargs['pk'])
+        context['listed_users'] = [getattr(follow, self.listed_user_field) for follow in context['object_list']]
+        context['followed_ids'] = Follow.objects.get_followed_ids(self.request.user, context['listed_users'])
+        context['title'] = self.title
+        context.update(self.get_header_context(self.request.user.id, selected_nav_elem='PROFILE'))
 
         return context
 
 
+class FollowersList(FollowList):
+    profile_field = 'followed_id'
+    listed_user_field = 'user'
+    title = 'Subscribers'
+
+
+class FollowingList(FollowList):
+    profile_field = 'user'
+    listed_user_field = 'followed_id'
+    title = 'Subscriptions'
+
+
 class EditProfilePage(HeaderContextMixin, LoginRequiredMixin, UpdateView):
     model = CustomUser
     form_class = CustomUserChangeForm
@@ -306,11 +361,33 @@ class EditProfilePage(HeaderContextMixin, LoginRequiredMixin, UpdateView):
         return context
 
 
-class Feed(HeaderContextMixin, PostContextMixin, ListView):
+class DeleteAccount(HeaderContextMixin, LoginRequiredMixin, TemplateView):
+    template_name = 'dj_gram/account_confirm_delete.html'
+
+    def post(self, request, *args, **kwargs):
+        request.user.request_deletion()
+        logout(request)
+        messages.success(request, 'Your account has been deleted.')
+        return redirect(reverse('dj_gram:feed'))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(self.get_header_context(self.request.user.id, selected_nav_elem='PROFILE'))
+        context['previous_page'] = reverse('dj_gram:edit_profile', kwargs={'pk': self.request.user.id})
+
+        return context
+
+
+class Feed(HeaderContextMixin, PostContextMixin, CursorPaginationMixin, AnonymousPageCacheMixin, ListView):
     model = Post
     context_object_name = 'posts'
     template_name = 'dj_gram/feed.html'
     paginate_by = 3
+    selected_nav_elem = 'FEED'
+
+    def get_queryset(self):
+        self.queryset = Post.objects.for_cards()
+        return super().get_queryset()
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -319,17 +396,43 @@ class Feed(HeaderContextMixin, PostContextMixin, ListView):
             post_context = self.get_post_context(context['posts'])
             context.update(post_context)
 
-        header_context = self.get_header_context(self.request.user.id, selected_nav_elem='FEED')
+        header_context = self.get_header_context(self.request.user.id, selected_nav_elem=self.selected_nav_elem)
         context.update(header_context)
 
         return context
 
 
+class FollowingFeed(LoginRequiredMixin, Feed):
+    """
+    Home timeline built of posts of followed authors. Precomputed TimelineEntry rows
+    are merged with recent posts of followed authors which are not fanned out.
+    """
+    selected_nav_elem = 'FOLLOWING'
+
+    def get_queryset(self):
+        before = after = None
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        if cursor:
+            direction, pk = CursorPage.decode_cursor(cursor)
+            if direction == CursorPage.next_direction:
+                before = pk
+            else:
+                after = pk
+
+        post_ids = TimelineEntry.objects.get_page_post_ids(self.request.user, limit=self.paginate_by + 1,
+                                                           before=before, after=after)
+        return Post.objects.for_cards().filter(id__in=post_ids)
+
+
 class ViewPost(HeaderContextMixin, PostContextMixin, LoginRequiredMixin, DetailView):
     model = Post
     context_object_name = 'post'
     template_name = 'dj_gram/view_post.html'
 
+    def get_queryset(self):
+        self.queryset = Post.objects.for_cards()
+        return super().get_queryset()
+
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
         post_context = self.get_post_context([context['post']])
@@ -341,27 +444,29 @@ class ViewPost(HeaderContextMixin, PostContextMixin, LoginRequiredMixin, DetailV
 
 
 class Voting(LoginRequiredMixin, View):
+    """
+    Votes are POSTed by the script of the post footer, which gets the new counters as JSON,
+    or by the vote form without JavaScript, which is redirected back. GET never votes,
+    it's where a login sends an anonymous voter back, so it shows the post.
+    """
     def get(self, *args, **kwargs):
-        vote = bool(self.kwargs['vote'])
-        post = Post.objects.get(pk=self.kwargs['post_id'])
-        user_vote = Vote.objects.filter(post=post, user=self.request.user).first()
+        return redirect('dj_gram:view_post', pk=self.kwargs['post_id'])
 
-        if not user_vote:
-            Vote.objects.create(user=self.request.user, post=post, vote=vote)
-        else:
-            if user_vote.vote == vote:
-                user_vote.delete()
-            else:
-                user_vote.vote = vote
-                user_vote.save()
+    def post(self, request, *args, **kwargs):
+        post = get_object_or_404(Post, pk=self.kwargs['post_id'])
+        like_count, dislike_count, vote = Vote.objects.toggle(request.user, post, bool(self.kwargs['vote']))
+        invalidate_post_pages(post.id)
 
-        return redirect(self.request.META.get('HTTP_REFERER'))
+        if request.headers.get('Accept') == 'application/json':
+            return JsonResponse({'like_count': like_count, 'dislike_count': dislike_count, 'vote': vote})
+        return redirect(request.META.get('HTTP_REFERER') or reverse('dj_gram:view_post', args=[post.id]))
 
 
 class Subscribe(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         if request.user.id != self.kwargs['followed_user_id']:
-            followed_user = get_object_or_404(CustomUser, id=self.kwargs['followed_user_id'])
+            followed_user = get_object_or_404(CustomUser, id=self.kwargs['followed_user_id'],
+                                              deletion_requested_at__isnull=True)
 
             if self.kwargs['action'] == 'subscribe':
                 self._subscribe(request, followed_user)
@@ -374,22 +479,13 @@ class Subscribe(LoginRequiredMixin, View):
 
     @staticmethod
     def _subscribe(request, followed_user):
-        try:
-            Follow.objects.create(user=request.user, followed_id=followed_user)
-            followed_user.followed_count = followed_user.followed_count + 1
-            followed_user.save(update_fields=['followed_count'])
-            request.user.follow_count = request.user.follow_count + 1
-            request.user.save(update_fields=['follow_count'])
+        if Follow.objects.follow(request.user, followed_user):
             messages.success(request, 'You\'ve successfully followed user.')
-        except IntegrityError:
+        else:
             messages.error(request, 'You\'ve already followed this user.')
 
     @staticmethod
     def _unsubscribe(request, followed_user):
-        follow = get_object_or_404(Follow, user=request.user, followed_id=followed_user)
-        follow.delete()
-        followed_user.followed_count = followed_user.followed_count - 1
-        followed_user.save(update_fields=['followed_count'])
-        request.user.follow_count = request.user.follow_count - 1
-        request.user.save(update_fields=['follow_count'])
+        if not Follow.objects.unfollow(request.user, followed_user):
+            raise Http404
         messages.success(request, 'You\'ve successfully unfollowed user.')